@@ -20,12 +20,42 @@ SIMPLE_ATTACHMENTS = {"doc": "Document: “%(title)s” — %(url)s",
 	"video": "Video: %(title)s (%(description)s, %(views)d views) — https://vk.com/video%(owner_id)s_%(id)s"}  # TODO: Add duration
 
 
+def getAttachmentsOwners(self, msg, users, groups):
+	"""
+	Collects the ids of the users and groups whose names are needed to parse the attachments
+	"""
+	for attachment in msg.get("attachments", ()):
+		type = attachment.get("type")
+		current = attachment.get(type, {})
+		if type == "wall" and self.settings.parse_wall:
+			tid = current.get("to_id", 1)
+			(users if tid > 0 else groups).add(tid)
+			getAttachmentsOwners(self, current, users, groups)
+		elif type == "wall_reply" and "from_id" in current:
+			users.add(current["from_id"])
+
+
+def prefetchNames(self, users, groups):
+	"""
+	Gets the names of the users and groups by one request for each kind
+	So they're taken from the cache when the message is parsed
+	"""
+	if users:
+		self.vk.getUsersData(users)
+	if groups:
+		self.vk.getGroupsData(groups)
+
+
 def parseAttachments(self, msg, spacer=""):
 	"""
 	“parses” attachments from the json to a string
 	"""
 	result = ""
 	if msg.has_key("attachments"):
+		if not spacer:
+			users, groups = set(), set()
+			getAttachmentsOwners(self, msg, users, groups)
+			prefetchNames(self, users, groups)
 		attachments = msg["attachments"]
 		# Add new line and "Attachments" if there some text added
 		if msg.get("body") and len(attachments) > 1:
@@ -10,16 +10,28 @@ Implements XEP-0153: vCard-Based Avatars
 
 class AvatarHash(object):
 	def __init__(self):
-		runDatabaseQuery("create table if not exists avatar_hash "
-			"(id text unique, sha text, updated integer)", set=True)
-
+		self.tableLock = threading.Lock()
+		self.tableCreated = False
 		self.baseHash = self.hashPhotos([{"uid": TransportID, "photo": URL_VCARD_NO_IMAGE}])
 		self.pending = set([])
 
 	join = lambda uids: ",".join([str(uid) for uid in uids])
 	join = staticmethod(join)
 
+	def initTable(self):
+		"""
+		Creates the table when it's needed for the first time
+		The database must not be touched while the extension is loaded:
+			it's done before the user is switched to RUN_AS and the worker processes are started
+		"""
+		with self.tableLock:
+			if not self.tableCreated:
+				runDatabaseQuery("create table if not exists avatar_hash "
+					"(id text unique, sha text, updated integer)", set=True)
+				self.tableCreated = True
+
 	def getLocalHashes(self, uids):
+		self.initTable()
 		data = runDatabaseQuery("select id, sha, updated from avatar_hash where id in (%s)" % self.join(uids)) or []
 		result = {}
 		for key in data:
@@ -70,7 +82,7 @@ class AvatarHash(object):
 			logger.debug("avatar_hash: updating hash database for user (jid: %s)", user.source)
 			hashes, date = self.getHashes(user, uids)
 			if hashes:
-				sql = "insert into avatar_hash (id, sha, updated) values "
+				sql = "insert or replace into avatar_hash (id, sha, updated) values "
 				for uid, value in hashes.iteritems():
 					sql += "(%s, %s, %s)," % (uid, repr(value), date)
 					local[uid] = value
@@ -80,6 +92,7 @@ class AvatarHash(object):
 
 	def updateHashes(self, user):
 		hashes, date = self.getHashes(user, list(self.pending))
+		self.initTable()
 		for uid, hash in hashes.iteritems():
 			runDatabaseQuery("update avatar_hash set sha=?, updated=? where id=?", (hash, date, uid), set=True)
 
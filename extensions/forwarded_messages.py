@@ -9,9 +9,23 @@ if not require("attachments"):
 
 BASE_SPACER = chr(32) + unichr(183) + chr(32)
 
+def getForwardedOwners(self, msg, users, groups):
+	"""
+	Collects the ids of the users and groups mentioned in the forwarded messages
+	"""
+	for fwd in msg.get("fwd_messages", ()):
+		users.add(fwd["user_id"])
+		getAttachmentsOwners(self, fwd, users, groups)
+		getForwardedOwners(self, fwd, users, groups)
+
+
 def parseForwardedMessages(self, msg, depth=0):
 	body = ""
 	if msg.has_key("fwd_messages"):
+		if not depth:
+			users, groups = set(), set()
+			getForwardedOwners(self, msg, users, groups)
+			prefetchNames(self, users, groups)
 		spacer = BASE_SPACER * depth
 		body = "\n" + spacer
 		body += _("Forwarded messages:")
@@ -133,7 +133,6 @@ def handleOutgoingChatMessage(self, vkChat):
 	if vkChat.has_key("chat_id"):
 		if not self.settings.groupchats:
 			return None
-		owner = vkChat.get("admin_id", "1")
 		chatID = vkChat["chat_id"]
 		chatJID = "%s_chat#%s@%s" % (self.vk.userID, chatID, ConferenceServer)
 
@@ -151,7 +150,20 @@ def handleOutgoingChatMessage(self, vkChat):
 		else:
 			chat = self.chats[chatJID]
 		if not chat.initialized:
-			chat.init(owner, chatID, chatJID, vkChat["title"], vkChat["date"], vkChat["chat_active"])
+			if "admin_id" in vkChat:
+				info = {"admin_id": vkChat["admin_id"], "title": vkChat["title"],
+					"users": vkChat.get("chat_active", [])}
+			else:
+				# the messages made from longpoll events don't carry the chat owner and users
+				try:
+					info = Chat.getVKChat(self, chatID)
+				except RuntimeError:
+					logger.warning("groupchats: unable to get chat %s, trying again after 10 seconds (jid: %s)",
+						chatID, self.source)
+					utils.runThread(handleOutgoingChatMessage, (self, vkChat), delay=10)
+					return None
+			chat.init(info["admin_id"], chatID, chatJID, info.get("title", vkChat.get("title")),
+				vkChat["date"], info.get("users", []))
 		if not chat.created:
 			if chat.creation_failed:
 				return None
@@ -254,8 +266,14 @@ class Chat(object):
 		Updates chat users and sends messages
 		Uses two users list to prevent losing anyone
 		"""
-		all_users = vkChat["chat_active"]
-		all_users = [int(user) for user in all_users if user]
+		if "chat_active" in vkChat:
+			all_users = [int(user) for user in vkChat["chat_active"] if user]
+		else:
+			# the messages made from longpoll events don't carry the chat users
+			# so we only add the sender to the ones we already know
+			all_users = [int(user) for user in self.raw_users if user]
+			if vkChat.get("user_id") and vkChat["user_id"] not in all_users:
+				all_users.append(vkChat["user_id"])
 		if userObject.settings.show_all_chat_users:
 			users = self.getVKChat(userObject, self.id)
 			if users:
@@ -267,6 +285,8 @@ class Chat(object):
 		if userObject.vk.getUserID() in buddies:
 			buddies.remove(userObject.vk.getUserID())
 
+		# the names of the joined users are got by one request
+		userObject.vk.getUsersData([user for user in buddies if user not in old_users])
 		for user in buddies:
 			jid = vk2xmpp(user)
 			if user not in old_users:
@@ -423,6 +443,15 @@ def exterminateChats(user=None, chats=[]):
 		runDatabaseQuery("delete from groupchats where jid=?", (jid,), set=True)
 
 
+# see runMigrations()
+GROUPCHATS_MIGRATIONS = (
+	# 1: one row for each chat (the last one is kept), the chats are looked up by the user
+	("delete from groupchats where rowid not in (select max(rowid) from groupchats group by jid)",
+		"create unique index if not exists groupchats_jid on groupchats (jid)",
+		"create index if not exists groupchats_user on groupchats (user)"),
+)
+
+
 def initChatsTable():
 	"""
 	Initializes database if it doesn't exist
@@ -441,6 +470,7 @@ def initChatsTable():
 		"(jid text, owner text,"
 		"user text, last_used integer, nick text)", set=True)
 	checkColumns()
+	runMigrations("groupchats", GROUPCHATS_MIGRATIONS)
 	return True
 
 
@@ -11,7 +11,7 @@ def typingreader_watch(msg):
 		user = Transport[source]
 		if user.settings.typingreader:
 			if (user.lastMsgID > user.lastMarkedMessage) and msg.getTag("composing"):
-				user.vk.method("messages.markAsRead", {"message_ids": str(user.lastMsgID)})
+				user.vk.methodAsync("messages.markAsRead", {"message_ids": str(user.lastMsgID)})
 				user.lastMarkedMessage = user.lastMsgID
 
 
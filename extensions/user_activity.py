@@ -14,8 +14,19 @@ Watches for inactive users and removes them
 """
 
 
+# see runMigrations()
+LAST_ACTIVITY_MIGRATIONS = (
+	# 1: one row for each user (the latest one is kept), so it can be replaced
+	("delete from last_activity where rowid not in "
+		"(select id from (select rowid as id, max(date) from last_activity group by jid))",
+		"create unique index if not exists last_activity_jid on last_activity (jid)",
+		"create index if not exists last_activity_date on last_activity (date)"),
+)
+
+
 def user_activity_evt01():
 	runDatabaseQuery("create table if not exists last_activity (jid text, date integer)", set=True)
+	runMigrations("last_activity", LAST_ACTIVITY_MIGRATIONS)
 	if isdef("USER_LIFETIME_LIMIT"):
 		user_activity_remove()
 	else:
@@ -27,11 +38,8 @@ def user_activity_evt01():
 
 def user_activity_evt05(user):
 	jid = user.source
-	exists = runDatabaseQuery("select jid from last_activity where jid=?", (jid,), many=False)
-	if not exists:
-		runDatabaseQuery("insert into last_activity values (?, ?)", (jid, time.time()), set=True)
-	else:
-		runDatabaseQuery("update last_activity set date=? where jid=?", (time.time(), jid), set=True)
+	bufferDatabaseQuery("insert or replace into last_activity (jid, date) values (?,?)",
+		(jid, time.time()), jid)
 
 
 def user_activity_remove():
@@ -41,7 +49,8 @@ def user_activity_remove():
 		if (time.time() - date) >= LA:
 			if jid not in Transport:
 				runDatabaseQuery("delete from users where jid=?", (jid,), set=True)
-				runDatabaseQuery("delete from last_activity where jid=?", (jid,))
+				registry.users.remove(jid)
+				runDatabaseQuery("delete from last_activity where jid=?", (jid,), set=True)
 				settings = "%s/%s" % (settingsDir, jid)
 				if os.path.exists(settings):
 					import shutil
@@ -57,10 +66,10 @@ def user_activity_remove():
 # A dirty hack to add seen users in stats
 def calcStats():
 	"""
-	Returns count(*) from users database
+	Returns the number of registered, seen and online users
 	"""
 	countOnline = len(Transport)
-	countTotal = runDatabaseQuery("select count(*) from users", many=False)[0]
+	countTotal = registry.users.count()
 	countSeen = runDatabaseQuery("select count(*) from last_activity where date >=?", (startTime,), many=False)[0]
 	return [countTotal, countSeen, countOnline]
 
@@ -40,14 +40,13 @@ reload(sys).setdefaultencoding("utf-8")
 
 # Now we can import our own modules
 import xmpp
-from itypes import Database
+from itypes import ConnectionPool, Writer, WriteBuffer
 from stext import setVars, _
 from defaults import *
 from printer import *
 from webtools import *
 
 Transport = {}
-Semaphore = threading.Semaphore()
 
 # command line arguments
 argParser = ArgumentParser()
@@ -78,6 +77,9 @@ from writer import *
 from longpoll import *
 from settings import *
 import vkapi as api
+import metrics
+import profiles
+import registry
 import utils
 
 # Compatibility with old config files
@@ -88,6 +90,31 @@ if not ADMIN_JIDS and evalJID:
 # DefLang for language id, root for the translations directory
 setVars(DefLang, root)
 
+# the API can be pointed at a local server (see tools/fakevk.py)
+api.API_URL = VK_API_URL
+api.pool.size = VK_API_POOL_SIZE
+api.BATCH_WINDOW = VK_API_BATCH_WINDOW / 1000.0
+api.limiter.configure(VK_API_RATE, VK_API_GLOBAL_RATE)
+api.REQUEST_DEADLINE = VK_API_DEADLINE
+profiles.cache.configure(PROFILE_CACHE_TTL, PROFILE_CACHE_SIZE, PROFILE_CACHE_MEMORY)
+
+# the connections are opened when they're needed, they're used for reading
+DatabasePool = ConnectionPool(DatabaseFile)
+DatabaseCommits = metrics.histogram("db/writer/commit")
+DatabaseCommitted = metrics.counter("db/writer/writes", "writes")
+# all the writes are made by one thread, the ones queued together are committed at once
+DatabaseWriter = Writer(DatabaseFile, observer=lambda count, seconds: (
+	DatabaseCommits.observe(seconds * 1000), DatabaseCommitted.inc(count)))
+metrics.gauge("db/writer/queue", DatabaseWriter.getQueueDepth, "writes")
+# query latency by the statement type (select, update, etc)
+DatabaseLatency = {}
+# the frequent updates (such as lastMsgID) are written together (see flushDatabase())
+DatabaseBuffer = WriteBuffer(DatabaseWriter, DATABASE_FLUSH_INTERVAL / 1000.0, DATABASE_FLUSH_LIMIT,
+	DATABASE_WRITE_TIMEOUT)
+DatabaseFlushes = metrics.histogram("db/flush")
+DatabaseFlushed = metrics.counter("db/flush/updates", "updates")
+metrics.gauge("db/buffer", lambda: len(DatabaseBuffer.pending), "updates")
+
 if THREAD_STACK_SIZE:
 	threading.stack_size(THREAD_STACK_SIZE)
 del formatter, loggerHandler
@@ -114,32 +141,137 @@ Stats = {"msgin": 0,  # from vk
 		"method": 0}
 
 
-def runDatabaseQuery(query, args=(), set=False, many=True):
+def runDatabaseQuery(query, args=(), set=False, many=True, wait=True):
 	"""
 	Executes sql to the database
+	The reads are made by the pool connections concurrently,
+		the writes (set=True) are made by the database writer thread (see DatabaseWriter)
+	Parameters:
+		wait: whether to wait until the write is committed,
+			if False the write is queued and the WriteResult is returned
 	"""
-	semph = None
-	if threading.currentThread() != "MainThread":
-		semph = Semaphore
-	with Database(DatabaseFile, semph) as db:
-		db(query, args)
-		if set:
-			db.commit()
-			result = None
-		elif many:
-			result = db.fetchall()
-		else:
-			result = db.fetchone()
-	return result
+	start = time.time()
+	if set:
+		result = DatabaseWriter.write(query, args)
+		if not wait:
+			return result
+		try:
+			return result.wait(DATABASE_WRITE_TIMEOUT)
+		finally:
+			observeDatabaseQuery(query, start)
+	if many:
+		fetch = "all"
+	else:
+		fetch = "one"
+	try:
+		return DatabasePool(query, args, fetch)
+	finally:
+		observeDatabaseQuery(query, start)
+
+
+def observeDatabaseQuery(query, start):
+	kind = query.split(None, 1)[0].lower()
+	if kind not in DatabaseLatency:
+		DatabaseLatency[kind] = metrics.histogram("db/query/%s" % kind)
+	DatabaseLatency[kind].observe((time.time() - start) * 1000)
+
+
+def bufferDatabaseQuery(query, args, key):
+	"""
+	Adds the update to the buffer instead of executing it at once
+	Only the latest update made by the query for the key is written
+	"""
+	DatabaseBuffer.put(query, args, key)
+
+
+def flushDatabase():
+	"""
+	Writes the buffered updates
+	"""
+	start = time.time()
+	try:
+		count = DatabaseBuffer.flush()
+	except Exception:
+		crashLog("database.flush")
+	else:
+		if count:
+			DatabaseFlushes.observe((time.time() - start) * 1000)
+			DatabaseFlushed.inc(count)
+
+
+def syncDatabase(timeout=10):
+	"""
+	Writes the buffered updates and waits for all the queued writes to be committed
+	Used before the transport stops
+	"""
+	flushDatabase()
+	try:
+		DatabaseWriter.sync(timeout)
+	except Exception:
+		crashLog("database.sync")
+
+
+def databaseFlusher():
+	"""
+	Flushes the buffer every DATABASE_FLUSH_INTERVAL (or as soon as it's full)
+	"""
+	while ALIVE:
+		DatabaseBuffer.wait()
+		flushDatabase()
+
+
+def runMigrations(name, migrations):
+	"""
+	Brings the tables to the latest schema version
+	Parameters:
+		name: the name the version is kept by in the schema_version table
+		migrations: a list of migrations, each one is a list of sql statements
+			migration number N (starting from 1) makes schema version N
+	Each migration is made atomically along with the version update
+	"""
+	runDatabaseQuery("create table if not exists schema_version "
+		"(name text primary key, version integer)", set=True)
+	row = runDatabaseQuery("select version from schema_version where name=?", (name,), many=False)
+	version = row[0] if row else 0
+	for number, statements in enumerate(migrations[version:], version + 1):
+		logger.info("main: migrating %s to schema version %d", name, number)
+		statements = [(statement, ()) for statement in statements]
+		statements.append(("insert or replace into schema_version (name, version) values (?,?)",
+			(name, number)))
+		DatabaseWriter.submit(statements).wait(DATABASE_WRITE_TIMEOUT)
+
+
+# see runMigrations()
+USERS_MIGRATIONS = (
+	# 1: one row for each user (the last one is kept)
+	("delete from users where rowid not in (select max(rowid) from users group by jid)",
+		"create unique index if not exists users_jid on users (jid)"),
+)
 
 
 def initDatabase(filename):
 	"""
 	Initializes database if it doesn't exist
 	"""
+	def checkColumns():
+		"""
+		Checks and adds additional column(s) into the users table
+		"""
+		info = runDatabaseQuery("pragma table_info(users)")
+		names = [col[1] for col in info]
+		for name, type in (("pollServer", "text"), ("pollKey", "text"),
+			("pollTs", "integer"), ("pollPts", "integer")):
+			if name not in names:
+				logger.warning("main: adding \"%s\" column to users table", name)
+				runDatabaseQuery("alter table users add column %s %s" % (name, type), set=True)
+
 	runDatabaseQuery("create table if not exists users"
 		"(jid text, username text, token text, "
-			"lastMsgID integer, rosterSet bool)", set=True)
+			"lastMsgID integer, rosterSet bool, "
+			"pollServer text, pollKey text, pollTs integer, pollPts integer)", set=True)
+	checkColumns()
+	runMigrations("users", USERS_MIGRATIONS)
+	registry.users.load(runDatabaseQuery("select %s from users" % str.join(", ", registry.COLUMNS)))
 	return True
 
 
@@ -201,7 +333,20 @@ escape = re.compile("|".join(unichr(x) for x in badChars),
 sortMsg = lambda first, second: first.get("id", 0) - second.get("id", 0)
 require = lambda name: os.path.exists("extensions/%s.py" % name)
 isdef = lambda var: var in globals()
-findUserInDB = lambda source: runDatabaseQuery("select * from users where jid=?", (source,), many=False)
+
+
+def findUserInDB(source):
+	"""
+	Returns the user's row (see registry.COLUMNS) or None if the user isn't registered
+	The row is taken from the registry, which is updated along with the database
+	"""
+	return registry.users.get(source)
+
+
+# a groupchat always has uid > 2000000000
+CHAT_ID_OFFSET = 2000000000
+# longpoll event attachments that can't be turned into a message without messages.getById
+EXPANDABLE_ATTACHMENTS = ("attach", "fwd", "geo", "source_")
 
 
 class VK(object):
@@ -212,8 +357,12 @@ class VK(object):
 	def __init__(self, token=None, source=None):
 		self.token = token
 		self.source = source
-		self.pollConfig = {"mode": 66, "wait": 30, "act": "a_check"}
+		# mode 2 makes the server send attachments and the chat info (sender, title) in the events
+		# mode 32 makes it send pts which is used to get the missed events by messages.getLongPollHistory
+		self.pollConfig = {"mode": 98, "wait": 30, "act": "a_check"}
 		self.pollServer = ""
+		self.pollPts = 0
+		self.pollConnection = None
 		self.pollInitialzed = False
 		self.online = False
 		self.userID = 0
@@ -254,27 +403,78 @@ class VK(object):
 		self.pollInitialzed = False
 		logger.debug("longpoll: requesting server address (jid: %s)", self.source)
 		try:
-			response = self.method("messages.getLongPollServer", {"use_ssl": 1, "need_pts": 0})
+			response = self.method("messages.getLongPollServer", {"use_ssl": 1, "need_pts": 1})
 		except Exception:
 			response = None
 		if not response:
 			logger.warning("longpoll: no response!")
 			return False
-		self.pollServer = "https://%s" % response.pop("server")
+		self.setPollServer(response)
+		return True
+
+	def setPollServer(self, response):
+		"""
+		Applies the messages.getLongPollServer response
+		Sends the events missed since the previous ts/pts and saves the new state
+		"""
+		ts, pts = self.pollConfig.get("ts"), self.pollPts
+		response = dict(response)
+		self.pollServer = response.pop("server")
+		if "://" not in self.pollServer:
+			self.pollServer = "https://%s" % self.pollServer
+		self.pollPts = response.pop("pts", 0)
 		self.pollConfig.update(response)
 		logger.debug("longpoll: server: %s (jid: %s)",
 			self.pollServer, self.source)
 		self.pollInitialzed = True
-		return True
+		user = Transport.get(self.source)
+		if user:
+			# the events happened while we were disconnected are taken from the history
+			if ts and pts:
+				user.catchUp(ts, pts)
+			user.savePollState()
+
+	def setPollState(self, server, key, ts, pts):
+		"""
+		Sets the longpoll state saved in the database
+		So the poll can be resumed without being initialized
+		"""
+		if server and key and ts:
+			self.pollServer = server
+			self.pollConfig.update({"key": key, "ts": ts})
+			self.pollPts = pts or 0
+			self.pollInitialzed = True
+
+	def getPollHistory(self, ts, pts):
+		"""
+		Gets the messages received since the ts/pts by messages.getLongPollHistory
+		Returns None if the history can't be received
+			(including the case when the ts/pts is too old or too new: errors 907, 908)
+		"""
+		values = {"ts": ts, "pts": pts, "msgs_limit": 200, "events_limit": 1000}
+		messages = []
+		for x in xrange(10):
+			response = self.method("messages.getLongPollHistory", values)
+			if not response or "error" in response:
+				return None
+			messages += response.get("messages", {}).get("items", [])
+			if response.get("new_pts"):
+				self.pollPts = values["pts"] = response["new_pts"]
+			if not response.get("more"):
+				break
+		return messages
 
 	def makePoll(self):
 		"""
 		Returns a socket connected to a poll server
+		The connection is kept alive and used again for the next requests
 		Raises api.LongPollError if poll not yet initialized (self.pollInitialzed)
 		"""
 		if not self.pollInitialzed:
 			raise api.LongPollError("The Poll wasn't initialized yet")
-		opener = api.AsyncHTTPRequest.getOpener(self.pollServer, self.pollConfig)
+		opener = api.AsyncHTTPRequest.getOpener(self.pollServer, self.pollConfig,
+			self.pollConnection)
+		self.pollConnection = opener
 		return opener
 
 	def method(self, method, args=None, force=False, notoken=False):
@@ -296,50 +496,86 @@ class VK(object):
 		if not self.engine.captcha and (self.online or force):
 			try:
 				result = self.engine.method(method, args, notoken=notoken)
-			except (api.InternalServerError, api.AccessDenied) as e:
-				if force:
+			except Exception as e:
+				if not self.handleMethodError(e, method, args, force):
 					raise
-
-			except api.CaptchaNeeded as e:
-				executeHandlers("evt04", (self, self.engine.captcha["img"]))
-				self.online = False
-
-			except api.ValidationRequired:
-				# TODO
-				raise
-
-			except api.NetworkNotFound as e:
-				self.online = False
-
-			except api.NotAllowed as e:
-				if self.engine.lastMethod[0] == "messages.send":
-					sendMessage(self.source,
-						vk2xmpp(args.get("user_id", TransportID)),
-						_("You're not allowed to perform this action."))
-
-			except api.VkApiError as e:
-				# There are several types of VkApiError
-				# But the user defenitely must be removed.
-				# The question is: how?
-				# Should we completely exterminate them or just remove?
-				roster = False
-				m = e.message
-				# Probably should be done in vkapi.py by status codes
-				if m == "User authorization failed: user revoke access for this token.":
-					roster = True
-				elif m == "User authorization failed: invalid access_token.":
-					sendMessage(self.source, TransportID,
-						m + " Please, register again")
-				utils.runThread(removeUser, (self.source, roster))
-				logger.error("VK: apiError %s (jid: %s)", m, self.source)
-				self.online = False
-			else:
-				return result
-			logger.error("VK: error %s occurred while executing"
-				" method(%s) (%s) (jid: %s)",
-				e.__class__.__name__, method, e.message, self.source)
 			return result
 
+	def methodAsync(self, method, args=None, callback=None, force=False, notoken=False):
+		"""
+		Non-blocking variant of self.method()
+		The request is made by the longpoll reactor and the errors are handled the same way
+		Returns api.Future, the callback (if set) is executed with it when the result is ready
+		"""
+		args = args or {}
+		future = api.Future(callback)
+		self.methods += 1
+		Stats["method"] += 1
+		if self.engine.captcha or not (self.online or force):
+			future.setResult(None)
+			return future
+
+		def handle(request):
+			try:
+				future.setResult(request.result())
+			except Exception as e:
+				if self.handleMethodError(e, method, args, force):
+					future.setResult({})
+				else:
+					future.setException(e)
+
+		self.engine.methodAsync(method, args, notoken, handle)
+		return future
+
+	def handleMethodError(self, e, method, args, force=False):
+		"""
+		Handles the exceptions raised while executing a method
+		Returns False if the exception must be raised to the caller
+		"""
+		if isinstance(e, (api.InternalServerError, api.AccessDenied)):
+			if force:
+				return False
+
+		elif isinstance(e, api.CaptchaNeeded):
+			executeHandlers("evt04", (self, self.engine.captcha["img"]))
+			self.online = False
+
+		elif isinstance(e, api.ValidationRequired):
+			# TODO
+			return False
+
+		elif isinstance(e, api.NetworkNotFound):
+			self.online = False
+
+		elif isinstance(e, api.NotAllowed):
+			if method == "messages.send":
+				sendMessage(self.source,
+					vk2xmpp(args.get("user_id", TransportID)),
+					_("You're not allowed to perform this action."))
+
+		elif isinstance(e, api.VkApiError):
+			# There are several types of VkApiError
+			# But the user defenitely must be removed.
+			# The question is: how?
+			# Should we completely exterminate them or just remove?
+			roster = False
+			m = e.message
+			# Probably should be done in vkapi.py by status codes
+			if m == "User authorization failed: user revoke access for this token.":
+				roster = True
+			elif m == "User authorization failed: invalid access_token.":
+				sendMessage(self.source, TransportID,
+					m + " Please, register again")
+			utils.runThread(removeUser, (self.source, roster))
+			logger.error("VK: apiError %s (jid: %s)", m, self.source)
+			self.online = False
+		else:
+			return False
+		logger.error("VK: error %s occurred while executing"
+			" method(%s) (%s) (jid: %s)",
+			e.__class__.__name__, method, e.message, self.source)
+		return True
+
 	@utils.threaded
 	def disconnect(self):
 		"""
@@ -392,6 +628,30 @@ class VK(object):
 			values["last_message_id"] = mid
 		return self.method("messages.get", values)
 
+	def getMessagesByID(self, ids):
+		"""
+		Gets the messages by their ids (up to 100) in one request
+		"""
+		return self.method("messages.getById", {"message_ids": str.join(",", [str(mid) for mid in ids])})
+
+	@staticmethod
+	def parsePollMessage(mid, uid, date, subject, body, attachments):
+		"""
+		Makes a message (the same way messages.get returns it) from a longpoll event
+		Returns None if the message has attachments which should be expanded by messages.getById
+		"""
+		for key in attachments:
+			if key.startswith(EXPANDABLE_ATTACHMENTS):
+				return None
+		message = {"out": 0, "id": mid, "date": date, "body": body}
+		if uid > CHAT_ID_OFFSET:
+			message["chat_id"] = uid - CHAT_ID_OFFSET
+			message["user_id"] = int(attachments.get("from", 0))
+			message["title"] = subject
+		else:
+			message["user_id"] = uid
+		return message
+
 	def getUserID(self):
 		"""
 		Gets user id
@@ -400,31 +660,65 @@ class VK(object):
 			self.userID = self.method("execute.getUserID_new")
 		return self.userID
 
-	@utils.cache
+	def getUserIDAsync(self):
+		"""
+		Gets user id without blocking
+		"""
+		def setUserID(future):
+			if not future.exception:
+				self.userID = self.userID or future.value
+
+		if not self.userID:
+			self.methodAsync("execute.getUserID_new", callback=setUserID)
+
 	def getGroupData(self, gid, fields=None):
 		"""
 		Gets group data (only name so far)
+		The data is taken from the profile cache if possible
 		"""
-		fields = fields or ["name"]
-		data = self.method("groups.getById", {"group_id": abs(gid), "fields": str.join(",", fields)})
-		if data:
-			data = data[0]
-		return data
+		return profiles.cache.get("group", abs(gid), fields or [], self.fetchGroupData, self.cache)
+
+	def getGroupsData(self, gids, fields=None):
+		"""
+		Gets data of many groups at once
+		Returns a dict of {gid: data} (gids are positive)
+		"""
+		gids = [abs(gid) for gid in gids]
+		return profiles.cache.getMany("group", gids, fields or [], self.fetchGroupData, self.cache)
+
+	def fetchGroupData(self, gids, fields):
+		return self.method("groups.getById", {"group_ids": str.join(",", map(str, gids)),
+			"fields": str.join(",", fields or ["name"])})
 
-	@utils.cache
 	def getUserData(self, uid, fields=None):
 		"""
 		Gets user data. Such as name, photo, etc
+		The data is taken from the profile cache if possible
 		"""
+		return self.getUsersData([uid], fields).get(uid, {})
+
+	def getUsersData(self, uids, fields=None):
+		"""
+		Gets data of many users by one users.get call
+		Used to get the data needed to process a message before it's processed
+		Returns a dict of {uid: data}
+		"""
+		result = {}
 		if not fields:
 			user = Transport.get(self.source)
-			if user and uid in user.friends:
-				return user.friends[uid]
+			if user:
+				result = dict((uid, user.friends[uid]) for uid in uids if uid in user.friends)
+			uids = [uid for uid in uids if uid not in result]
 			fields = ["screen_name"]
-		data = self.method("users.get", {"user_ids": uid, "fields": str.join(",", fields)})
-		if data:
-			data = data[0]
-			data["name"] = self.formatName(data)
+		if uids:
+			result.update(profiles.cache.getMany("user", uids, fields, self.fetchUserData, self.cache))
+		return result
+
+	def fetchUserData(self, uids, fields):
+		data = self.method("users.get", {"user_ids": str.join(",", map(str, uids)),
+			"fields": str.join(",", fields)})
+		for user in data or ():
+			user["name"] = self.formatName(user)
 		return data
 
 	def sendMessage(self, body, id, mType="user_id", more={}):
@@ -464,6 +758,8 @@ class User(object):
 		self.resources = set([])
 		self.settings = Settings(source)
 		self.last_udate = time.time()
+		# when the friends' vcard data was fetched (see mod_iq_vcard)
+		self.vcardsPrefetched = 0
 		self.sync = threading._allocate_lock()
 		logger.debug("User initialized (jid: %s)", self.source)
 
@@ -480,7 +776,7 @@ class User(object):
 			logger.debug("User was found in the database... (jid: %s)", self.source)
 			if not token:
 				logger.debug("... but no token was given. Using the one from the database (jid: %s)", self.source)
-				_, _, token, self.lastMsgID, self.rosterSet = user
+				token, self.lastMsgID, self.rosterSet = user[2:5]
 
 		if not (token or password):
 			logger.warning("User wasn't found in the database and no token or password was given!")
@@ -492,6 +788,8 @@ class User(object):
 			token = pwd.confirm()
 
 		self.vk = vk = VK(token, self.source)
+		if exists and token == user[2]:
+			vk.setPollState(*user[5:])
 		try:
 			vk.auth()
 		except api.CaptchaNeeded:
@@ -505,10 +803,13 @@ class User(object):
 				# Anyways, it won't hurt anyone
 				runDatabaseQuery("update users set token=? where jid=?",
 					(vk.getToken(), self.source), True)
+				registry.users.update(self.source, token=vk.getToken())
 			else:
 				runDatabaseQuery("insert into users (jid, token, lastMsgID, rosterSet) values (?,?,?,?)",
 					(self.source, vk.getToken(),
 						self.lastMsgID, self.rosterSet), True)
+				registry.users.add(self.source, token=vk.getToken(),
+					lastMsgID=self.lastMsgID, rosterSet=self.rosterSet)
 			executeHandlers("evt07", (self,))
 			self.friends = vk.getFriends()
 		return vk.online
@@ -517,6 +818,7 @@ class User(object):
 		self.rosterSet = True
 		runDatabaseQuery("update users set rosterSet=? where jid=?",
 			(self.rosterSet, self.source), True)
+		registry.users.update(self.source, rosterSet=self.rosterSet)
 
 	def initialize(self, force=False, send=True, resource=None):
 		"""
@@ -544,8 +846,10 @@ class User(object):
 			self.sendInitPresence()
 		if resource:
 			self.resources.add(resource)
-		utils.runThread(self.vk.getUserID)
-		self.sendMessages(True)
+		self.vk.getUserIDAsync()
+		# the resumed poll will return the messages we missed
+		if not self.vk.pollInitialzed:
+			self.sendMessages(True)
 		Poll.add(self)
 		utils.runThread(executeHandlers, ("evt05", (self,)))
 
@@ -635,10 +939,60 @@ class User(object):
 						if self.settings.force_vk_date or init:
 							date = message["date"]
 						sendMessage(self.source, fromjid, escape("", body), date)
-		if messages:
-			self.lastMsgID = messages[-1]["id"]
-			runDatabaseQuery("update users set lastMsgID=? where jid=?",
-				(self.lastMsgID, self.source), True)
+			# the messages sent earlier may have greater ids
+			self.lastMsgID = max(self.lastMsgID, messages[-1]["id"])
+			bufferDatabaseQuery("update users set lastMsgID=? where jid=?",
+				(self.lastMsgID, self.source), self.source)
+			registry.users.update(self.source, lastMsgID=self.lastMsgID)
+
+	def savePollState(self):
+		"""
+		Saves the longpoll server, key, ts and pts in the database
+		"""
+		vk = self.vk
+		state = (vk.pollServer, vk.pollConfig.get("key"), vk.pollConfig.get("ts"), vk.pollPts)
+		bufferDatabaseQuery("update users set pollServer=?, pollKey=?, pollTs=?, pollPts=? where jid=?",
+			state + (self.source,), self.source)
+		registry.users.update(self.source, **dict(zip(registry.COLUMNS[5:], state)))
+
+	def catchUp(self, ts, pts):
+		"""
+		Sends the messages received since the ts/pts
+		Requests the last ones by messages.get if the history isn't available
+		"""
+		logger.debug("longpoll: getting the history since ts: %s, pts: %s (jid: %s)", ts, pts, self.source)
+		messages = self.vk.getPollHistory(ts, pts)
+		if messages is None:
+			self.sendMessages(True)
+		else:
+			messages = [message for message in messages if message["id"] > self.lastMsgID]
+			if messages:
+				self.sendMessages(True, messages)
+
+	def sendPollMessages(self, messages, pending):
+		"""
+		Sends the messages made from longpoll events
+		Expands the pending ones by a single messages.getById call
+		If it's failed, all the new messages are requested by messages.get
+		Saves the longpoll state after the messages are sent
+		Parameters:
+			messages: messages made from the events
+			pending: ids of the messages need to be expanded
+		"""
+		if pending:
+			expanded = []
+			for i in xrange(0, len(pending), 100):
+				response = self.vk.getMessagesByID(pending[i:i + 100])
+				if not response or not response.get("items"):
+					logger.warning("longpoll: unable to get messages by id, requesting all the new ones (jid: %s)",
+						self.source)
+					messages = None
+					break
+				expanded += response["items"]
+			else:
+				messages = messages + expanded
+		self.sendMessages(None, messages)
+		self.savePollState()
 
 	def processPollResult(self, opener):
 		"""
@@ -658,7 +1012,14 @@ class User(object):
 		data = None
 		try:
 			data = opener.read()
-		except (httplib.BadStatusLine, socket.error, socket.timeout) as e:
+		except (httplib.HTTPException, socket.error, socket.timeout) as e:
+			Poll.reconnects["socket"].inc()
+			if opener.reused:
+				# the server has probably closed the connection before we sent the request
+				# so we just need to make a new one
+				logger.debug("longpoll: reused connection is broken (`%s`), reconnecting (jid: %s)",
+					e.__class__.__name__, self.source)
+				return 1
 			logger.warning("longpoll: got error `%s` (jid: %s)", e.__class__.__name__,
 				self.source)
 			return 0
@@ -667,18 +1028,32 @@ class User(object):
 			if not data:
 				raise ValueError()
 		except ValueError:
+			Poll.reconnects["empty"].inc()
 			logger.error("longpoll: no data. Gonna request again (jid: %s)",
 				self.source)
 			return 1
+		return self.processPollData(data)
 
+	def processPollData(self, data):
+		"""
+		Processes the decoded poll response
+		Return codes are the same as processPollResult() has
+		"""
 		if "failed" in data:
+			Poll.reconnects["failed"].inc()
 			logger.debug("longpoll: failed. Searching for a new server (jid: %s)",
 				self.source)
 			return 0
 
 		self.vk.pollConfig["ts"] = data["ts"]
-
-		for evt in data.get("updates", ()):
+		if "pts" in data:
+			self.vk.pollPts = data["pts"]
+
+		messages = []
+		pending = []
+		updates = data.get("updates", ())
+		Poll.events.observe(len(updates))
+		for evt in updates:
 			typ = evt.pop(0)
 
 			if DEBUG_POLL:
@@ -686,14 +1061,15 @@ class User(object):
 
 			if typ == 4:  # new message
 				if len(evt) == 7:
-					message = None
 					mid, flags, uid, date, subject, body, attachments = evt
 					out = flags & 2 == 2
-					chat = uid > 2000000000  # a groupchat always has uid > 2000000000
-					if not out:
-						if not attachments and not chat:
-							message = [{"out": 0, "user_id": uid, "id": mid, "date": date, "body": body}]
-						utils.runThread(self.sendMessages, (None, message), "sendMessages-%s" % self.source)
+					# the resumed poll may return the messages we've already sent
+					if not out and mid > self.lastMsgID:
+						message = self.vk.parsePollMessage(mid, uid, date, subject, body, attachments or {})
+						if message:
+							messages.append(message)
+						else:
+							pending.append(mid)
 				else:
 					logger.warning("longpoll: incorrect events number while trying to process arguments %s (jid: %s)", str(evt), self.source)
 
@@ -709,6 +1085,10 @@ class User(object):
 				if evt[0] not in self.typing:
 					sendMessage(self.source, vk2xmpp(evt[0]), typ="composing")
 				self.typing[evt[0]] = time.time()
+
+		if messages or pending:
+			# queued after the user's previous messages, so they're sent in order
+			Poll.delivery.put(self.source, self.sendPollMessages, (messages, pending))
 		return 1
 
 	def updateTypingUsers(self, cTime):
@@ -853,10 +1233,10 @@ def updateCron():
 
 def calcStats():
 	"""
-	Returns count(*) from users database
+	Returns the number of registered and online users
 	"""
 	countOnline = len(Transport)
-	countTotal = runDatabaseQuery("select count(*) from users", many=False)[0]
+	countTotal = registry.users.count()
 	return [countTotal, countOnline]
 
 
@@ -880,6 +1260,7 @@ def removeUser(user, roster=False, notify=True):
 				" Let us know if you feel exploited."), -1)
 	logger.debug("User: removing user from db (jid: %s)" % source)
 	runDatabaseQuery("delete from users where jid=?", (source,), True)
+	registry.users.remove(source)
 	logger.debug("User: deleted (jid: %s)", source)
 	if source in Transport:
 		del Transport[source]
@@ -960,10 +1341,9 @@ def initializeUsers():
 	Initializes users by sending them "probe" presence
 	"""
 	Print("#-# Initializing users", False)
-	users = runDatabaseQuery("select jid from users")
-	for user in users:
+	for jid in registry.users.getJids():
 		Print(".", False)
-		sendPresence(user[0], TransportID, "probe")
+		sendPresence(jid, TransportID, "probe")
 	Print("\n#-# Component %s initialized well." % TransportID)
 
 
@@ -975,6 +1355,7 @@ def runMainActions():
 		utils.runThread(event, name=("extension-%d" % num))
 	utils.runThread(Poll.process, name="longPoll")
 	utils.runThread(updateCron)
+	utils.runThread(databaseFlusher)
 	import modulemanager
 	Manager = modulemanager.ModuleManager
 	Manager.load(Manager.list())
@@ -994,6 +1375,10 @@ def main():
 		logger.warning("switching to user %s:%s", RUN_AS, uid)
 		os.setuid(uid)
 	checkPID()
+	# the worker processes must not inherit the database connections and the writer thread
+	# the database files (including -wal and -shm) must be created by RUN_AS user
+	if LONGPOLL_SHARDS:
+		Shards.start(LONGPOLL_SHARDS)
 	initDatabase(DatabaseFile)
 	if connect():
 		initializeUsers()
@@ -1009,6 +1394,7 @@ def disconnectHandler(crash=True):
 	And writes a crash log if crash parameter is True
 	"""
 	executeHandlers("evt02")
+	syncDatabase()
 	if crash:
 		crashLog("main.disconnect")
 	logger.critical("disconnecting from the server")
@@ -1039,6 +1425,7 @@ def exit(signal=None, frame=None):
 		Print("." * len(user.friends), False)
 	Print("\n")
 	executeHandlers("evt02")
+	syncDatabase()
 	try:
 		os.remove(pidFile)
 	except OSError:
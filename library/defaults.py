@@ -19,6 +19,21 @@ DEBUG_POLL = None
 DEBUG_API = []
 STANZA_SEND_INTERVAL = 0.03125
 THREAD_STACK_SIZE = 0
+LONGPOLL_WORKERS = 8
+LONGPOLL_INIT_CONCURRENCY = 4
+LONGPOLL_SHARDS = 0
+VK_API_URL = "https://api.vk.com/method/"
+VK_API_POOL_SIZE = 16
+VK_API_BATCH_WINDOW = 0
+VK_API_RATE = 3
+VK_API_GLOBAL_RATE = 0
+VK_API_DEADLINE = 30
+PROFILE_CACHE_TTL = 3600
+PROFILE_CACHE_SIZE = 50000
+PROFILE_CACHE_MEMORY = 32
+DATABASE_FLUSH_INTERVAL = 1000
+DATABASE_FLUSH_LIMIT = 500
+DATABASE_WRITE_TIMEOUT = 60
 VK_ACCESS = 69638
 USER_LIMIT = 0
 RUN_AS = None
@@ -9,6 +9,10 @@ Copyright (2010-2013) Al Korgun (alkorgun@gmail.com)
 Distributed under the GNU GPLv3.
 """
 
+import Queue
+import threading
+import time
+
 try:
 	import sqlite3
 except ImportError:
@@ -22,7 +26,10 @@ else:
 
 __all__ = [
 	"Number",
-	"Database"
+	"ConnectionPool",
+	"Writer",
+	"WriteResult",
+	"WriteBuffer"
 ]
 
 __version__ = "0.8"
@@ -64,72 +71,265 @@ class Number(object):
 
 	__le__ = lambda self, number: self.number <= number
 
-class LazyDescriptor(object): # not really lazy, but setter is not needed
-
-	def __init__(self, function):
-		self.fget = function
-
-	__get__ = lambda self, instance, owner: self.fget(instance)
+class ConnectionPool(object):
 
-class Database(object):
+	"""
+	Keeps the connections open, so the database isn't opened for each query.
+	A connection is used by one thread at a time and the statements are
+	prepared once for each connection (sqlite3's statement cache).
+	The connections are in autocommit mode and WAL journal is used,
+	so the readers don't wait for the writer.
+	"""
 
-	__connected = False
-
-	def __init__(self, filename, lock = None, timeout = 8):
+	def __init__(self, filename, size = 8, timeout = 8, statements = 256, journal = "WAL"):
 		self.filename = filename
-		self.lock = lock
+		self.size = size
 		self.timeout = timeout
-
-	def __connect(self):
-
-		assert not self.__connected, "already connected"
-
-		self.db = connect(self.filename, timeout = self.timeout)
-		self.cursor = self.db.cursor()
-		self.__connected = True
-		self.commit = self.db.commit
-		self.execute = self.cursor.execute
-		self.fetchone = self.cursor.fetchone
-		self.fetchall = self.cursor.fetchall
-		self.fetchmany = self.cursor.fetchmany
-
-	@LazyDescriptor
-	def execute(self):
-		self.__connect()
-		return self.execute
-
-	__call__ = lambda self, *args: self.execute(*args)
-
-	@LazyDescriptor
-	def db(self):
-		self.__connect()
-		return self.db
-
-	@LazyDescriptor
-	def cursor(self):
-		self.__connect()
-		return self.cursor
+		self.statements = statements
+		self.journal = journal
+		self.idle = []
+		self.lock = threading.Lock()
+
+	def connect(self):
+		db = connect(self.filename, timeout = self.timeout, cached_statements = self.statements,
+			isolation_level = None, check_same_thread = False)
+		if self.journal:
+			db.execute("pragma journal_mode = %s" % self.journal)
+			db.execute("pragma synchronous = normal")
+		return db
+
+	def get(self):
+		with self.lock:
+			if self.idle:
+				return self.idle.pop()
+		return self.connect()
+
+	def put(self, db):
+		with self.lock:
+			if len(self.idle) < self.size:
+				self.idle.append(db)
+				return None
+		db.close()
+
+	def __call__(self, query, args = (), fetch = "all"):
+		"""
+		Executes the query and returns all the rows ("all"), the first one ("one")
+		or nothing (None). The connection which failed is closed.
+		"""
+		db = self.get()
+		try:
+			cursor = db.execute(query, args)
+			if fetch == "all":
+				result = cursor.fetchall()
+			elif fetch == "one":
+				result = cursor.fetchone()
+			else:
+				result = None
+			cursor.close()
+		except Exception:
+			db.close()
+			raise
+		self.put(db)
+		return result
 
 	def close(self):
-
-		assert self.__connected, "not connected"
-
-		if self.cursor:
-			self.cursor.close()
-		if self.db.total_changes:
-			self.commit()
-		if self.db:
-			self.db.close()
-
-	def __enter__(self):
-		if self.lock:
-			self.lock.acquire()
-		return self
-
-	def __exit__(self, *args):
-		if self.lock:
-			self.lock.release()
-		if self.__connected:
-			self.close()
-
-del LazyDescriptor
+		with self.lock:
+			idle, self.idle = self.idle, []
+		for db in idle:
+			db.close()
+
+class WriteResult(object):
+
+	"""
+	The result of a write made by Writer.
+	"""
+
+	def __init__(self):
+		self.event = threading.Event()
+		self.value = None
+		self.error = None
+
+	def set(self, value = None, error = None):
+		self.value = value
+		self.error = error
+		self.event.set()
+
+	def wait(self, timeout = None):
+		"""
+		Returns the number of changed rows or raises the write error.
+		"""
+		if not self.event.wait(timeout):
+			raise RuntimeError("the write wasn't made in time")
+		if self.error:
+			raise self.error
+		return self.value
+
+class Writer(object):
+
+	"""
+	Makes all the writes by a single thread which owns the write connection.
+	The writes are queued and the ones waiting together are made
+	in one transaction (up to batch of them). Each write is a list of
+	statements made atomically, the failed write doesn't affect the others.
+	The callers can wait for the WriteResult or ignore it.
+	observer(count, seconds) is called after each transaction.
+	"""
+
+	def __init__(self, filename, timeout = 8, batch = 100, journal = "WAL", observer = None):
+		self.filename = filename
+		self.timeout = timeout
+		self.batch = batch
+		self.journal = journal
+		self.observer = observer
+		self.queue = Queue.Queue()
+		self.db = None
+		self.thread = None
+		self.lock = threading.Lock()
+
+	def start(self):
+		"""
+		Starts the writer thread, or starts it again if it has died
+		"""
+		with self.lock:
+			if not self.thread or not self.thread.is_alive():
+				# the connection can only be used by the thread which has opened it
+				self.db = None
+				self.thread = threading.Thread(target = self.run, name = "database.writer")
+				self.thread.daemon = True
+				self.thread.start()
+
+	def submit(self, statements):
+		"""
+		Queues the list of (query, args) to be executed atomically.
+		"""
+		result = WriteResult()
+		self.start()
+		self.queue.put((statements, result))
+		return result
+
+	def write(self, query, args = ()):
+		return self.submit([(query, args)])
+
+	def sync(self, timeout = None):
+		"""
+		Waits for the writes queued before.
+		"""
+		return self.submit([]).wait(timeout)
+
+	def getQueueDepth(self):
+		return self.queue.qsize()
+
+	def connect(self):
+		db = connect(self.filename, timeout = self.timeout, isolation_level = None)
+		if self.journal:
+			db.execute("pragma journal_mode = %s" % self.journal)
+			db.execute("pragma synchronous = normal")
+		return db
+
+	def run(self):
+		while True:
+			commands = [self.queue.get()]
+			while len(commands) < self.batch:
+				try:
+					commands.append(self.queue.get_nowait())
+				except Queue.Empty:
+					break
+			self.commit(commands)
+
+	def commit(self, commands):
+		start = time.time()
+		results = []
+		try:
+			if not self.db:
+				self.db = self.connect()
+			db = self.db
+			db.execute("begin immediate")
+			for statements, result in commands:
+				changes = db.total_changes
+				db.execute("savepoint write")
+				try:
+					for query, args in statements:
+						db.execute(query, args)
+				except Exception as e:
+					db.execute("rollback to write")
+					results.append((result, None, e))
+				else:
+					results.append((result, db.total_changes - changes, None))
+				db.execute("release write")
+			db.execute("commit")
+		except Exception as e:
+			# the transaction has failed as a whole (the database is locked or broken)
+			db, self.db = self.db, None
+			if db:
+				try:
+					db.close()
+				except Exception:
+					pass
+			for statements, result in commands:
+				result.set(error = e)
+			return None
+		for result, value, error in results:
+			result.set(value, error)
+		if self.observer:
+			try:
+				self.observer(len(commands), time.time() - start)
+			except Exception:
+				pass
+
+class WriteBuffer(object):
+
+	"""
+	Keeps the frequent updates in memory and writes them to the database
+	in one transaction. Only the latest update for each key is written.
+	flush() is called by the owner, wait() tells when it's time to do it:
+	every interval seconds or as soon as there are limit updates waiting.
+	"""
+
+	def __init__(self, writer, interval = 1, limit = 500, timeout = 60):
+		self.writer = writer
+		self.timeout = timeout
+		self.interval = interval
+		self.limit = limit
+		self.pending = {}
+		self.lock = threading.Lock()
+		self.flushLock = threading.Lock()
+		self.event = threading.Event()
+
+	def put(self, query, args, key):
+		"""
+		Adds the update replacing the one made by the same query for the same key
+		"""
+		with self.lock:
+			self.pending[(query, key)] = args
+			full = len(self.pending) >= self.limit
+		if full:
+			self.event.set()
+
+	def wait(self):
+		self.event.wait(self.interval)
+		self.event.clear()
+
+	def flush(self):
+		"""
+		Writes the waiting updates. They're kept if the transaction has failed
+		(unless they're replaced by the newer ones) if the database was
+		locked or unavailable.
+		"""
+		with self.flushLock:
+			with self.lock:
+				pending, self.pending = self.pending, {}
+			if not pending:
+				return 0
+			statements = [(query, args) for (query, key), args in pending.iteritems()]
+			try:
+				self.writer.submit(statements).wait(self.timeout)
+			except Exception as e:
+				# the database may be locked or unavailable for a while,
+				# but the broken statements would fail every time
+				if sqlite3 and isinstance(e, sqlite3.OperationalError) and \
+						any(reason in str(e) for reason in ("locked", "busy", "I/O", "unable to open")):
+					with self.lock:
+						pending.update(self.pending)
+						self.pending = pending
+				raise
+			return len(pending)
@@ -12,37 +12,83 @@ __license__ = "MIT"
 Implements a single-threaded longpoll client
 """
 
+import fcntl
+import httplib
+import metrics
+import multiprocessing
+import random
 import threading
 import time
 import vkapi as api
+import reactor
 import select
 import socket
 import utils
-from __main__ import Transport, logger, ALIVE, DEBUG_POLL, crashLog
+import zlib
+from __main__ import Transport, logger, ALIVE, DEBUG_POLL, LONGPOLL_WORKERS, \
+	LONGPOLL_INIT_CONCURRENCY, crashLog
 
 class Poll:
 	"""
 	Class used to handle longpoll
 	"""
 	__list = {}
+	__users = {}
+	# the non-blocking API requests (see watch())
+	__watched = {}
 	__buff = set()
 	__lock = threading._allocate_lock()
+	# sockets are registered once in __add() and unregistered when they're popped from __list
+	__reactor = reactor.Reactor()
+	# how often (in seconds) to look for the users who went offline
+	CLEANUP_INTERVAL = 10
+	# results are processed by a fixed number of workers
+	# a user is always served by the same worker, so their results are processed in order
+	workers = utils.WorkerPool(LONGPOLL_WORKERS, "poll.worker")
+	# the messages are sent (and expanded by the API calls) apart from the workers,
+	# so a slow user doesn't hold the results of the others
+	delivery = utils.SerialQueue("poll.delivery")
+	# the users from the buffer are re-initialized by the scheduler
+	# its size limits the number of messages.getLongPollServer calls made at once
+	scheduler = utils.Scheduler(LONGPOLL_INIT_CONCURRENCY, "poll.init")
+	# re-initialization attempts and the delays between them (in seconds)
+	INIT_ATTEMPTS = 10
+	INIT_DELAY = 2
+	INIT_DELAY_MAX = 300
+	# metrics (read by the stats handler)
+	reconnects = dict((reason, metrics.counter("poll/reconnects/%s" % reason))
+		for reason in ("failed", "socket", "empty"))
+	iterations = metrics.meter("poll/iterations")
+	# from the moment a socket has become ready to the moment its result is processed
+	latency = metrics.histogram("poll/latency")
+	events = metrics.histogram("poll/events", "events", (0, 1, 2, 5, 10, 25, 50, 100, 250))
 
 	@classmethod
-	def __add(cls, user):
+	def __add(cls, user, opener):
 		"""
-		Issues readable socket to use it in select()
-		Adds user in buffer on error occurred
-		Adds user in self.__list if no errors
+		Registers the opener's socket in the reactor
+		and adds user in self.__list
 		"""
-		if DEBUG_POLL:
-			logger.debug("longpoll: really adding user to poll (jid: %s)", user.source)
-		opener = user.vk.makePoll()
+		fd = opener.sock.fileno()
+		cls.__list[fd] = (user, opener)
+		cls.__users[user] = fd
+		cls.__reactor.register(fd, (reactor.READ if opener.connected else reactor.WRITE))
 		if DEBUG_POLL:
 			logger.debug("longpoll: user has been added to poll (jid: %s)", user.source)
-		cls.__list[opener.sock] = (user, opener)
 		return opener
 
+	@classmethod
+	def __pop(cls, fd):
+		"""
+		Removes the socket from the poll and the reactor
+		Raises KeyError if there is no such socket
+		"""
+		cls.__reactor.unregister(fd)
+		user, opener = cls.__list.pop(fd)
+		if cls.__users.get(user) == fd:
+			del cls.__users[user]
+		return (user, opener)
+
 	@classmethod
 	def __addToBuff(cls, user):
 		"""
@@ -52,128 +98,308 @@ class Poll:
 		"""
 		cls.__buff.add(user)
 		logger.debug("longpoll: adding user to the init buffer (jid: %s)", user.source)
-		utils.runThread(cls.__initPoll, (user,), "__initPoll-%s" % user.source)
+		cls.scheduler.schedule(cls.getInitDelay(0), cls.__initPoll, (user, 0))
+
+	@classmethod
+	def getInitDelay(cls, attempt):
+		"""
+		Returns the delay before the re-initialization attempt
+		The delay grows exponentially and a half of it is random,
+			so the users who failed at the same moment won't retry at the same moment
+		"""
+		delay = min(cls.INIT_DELAY * 2 ** attempt, cls.INIT_DELAY_MAX)
+		return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+	@classmethod
+	def getWaitingCount(cls):
+		"""
+		Returns the number of users waiting for their poll to be re-initialized
+		"""
+		return len(cls.__buff)
+
+	@classmethod
+	def getUserCount(cls):
+		"""
+		Returns the number of users in poll
+		"""
+		return len(cls.__list)
 
 	@classmethod
 	def add(cls, some_user):
 		"""
 		Adds the User class object to poll
+		The connection is only started here (see AsyncHTTPRequest.start())
+			and it's made by the reactor, so no network i/o happens under the lock
+		Adds user in buffer on error occurred
 		"""
 		if DEBUG_POLL:
 			logger.debug("longpoll: adding user to poll (jid: %s)", some_user.source)
+		if Shards.enabled:
+			return Shards.add(some_user)
 		with cls.__lock:
-			if some_user in cls.__buff:
+			if some_user in cls.__buff or some_user in cls.__users:
 				return None
-			for sock, (user, opener) in cls.__list.iteritems():
-				if some_user == user:
-					break
-			else:
+			# the place is taken until the connection is started
+			cls.__users[some_user] = None
+		try:
+			opener = some_user.vk.makePoll()
+		except Exception as e:
+			if not isinstance(e, (api.LongPollError,) + api.ERRORS):
+				crashLog("poll.add")
+			logger.error("longpoll: failed to make poll (jid: %s)", some_user.source)
+			with cls.__lock:
+				cls.__users.pop(some_user, None)
+				cls.__addToBuff(some_user)
+		else:
+			with cls.__lock:
+				cls.__add(some_user, opener)
+
+	@classmethod
+	def __retry(cls, user, opener):
+		"""
+		Adds user to poll again after their connection has failed
+		Or adds them to the buffer if there are no more attempts left
+		"""
+		if opener.attempts < api.REQUEST_RETRIES:
+			cls.add(user)
+		else:
+			logger.error("longpoll: failed to connect in %d attempts (jid: %s)",
+				opener.attempts, user.source)
+			with cls.__lock:
+				cls.__addToBuff(user)
+
+	@classmethod
+	def __step(cls, fd, user, opener):
+		"""
+		Moves the opener's connection to the next state
+		and changes the events its socket is watched for
+		"""
+		try:
+			events = opener.step()
+		except (httplib.HTTPException,) + api.ERRORS as e:
+			logger.warning("longpoll: connection failed: %s (jid: %s)", e, user.source)
+			with cls.__lock:
 				try:
-					cls.__add(some_user)
-				except Exception as e:
-					if not isinstance(e, api.LongPollError):
-						crashLog("poll.add")
-					logger.error("longpoll: failed to make poll (jid: %s)", some_user.source)
-					cls.__addToBuff(some_user)
+					cls.__pop(fd)
+				except KeyError:
+					return None
+			opener.fail()
+			# reconnecting may block (e.g. on resolving the host), so it's never done by the reactor
+			cls.workers.put(user.source, cls.__retry, (user, opener))
+		else:
+			with cls.__lock:
+				if fd in cls.__list:
+					cls.__reactor.modify(fd, events)
+
+	@classmethod
+	def watch(cls, opener, callback):
+		"""
+		Makes the started request by the reactor
+		callback(opener, error) is executed by the workers as soon as
+			the response is ready to be read (error is None) or the connection has failed
+		"""
+		fd = opener.sock.fileno()
+		with cls.__lock:
+			cls.__watched[fd] = (opener, callback)
+			cls.__reactor.register(fd, (reactor.READ if opener.connected else reactor.WRITE))
 
-	clear = staticmethod(__list.clear)
+	@classmethod
+	def __popWatched(cls, fd):
+		"""
+		Must be called under the lock
+		"""
+		cls.__reactor.unregister(fd)
+		return cls.__watched.pop(fd)
 
 	@classmethod
-	def __initPoll(cls, user):
+	def __stepWatched(cls, fd, mask, opener, callback):
 		"""
-		Tries to reinitialize poll if needed in 10 times (each 10 seconds)
-		As soon as poll initialized user will be removed from buffer
+		Moves the watched request to the next state
+		Or passes it to the callback if it's done
 		"""
-		for x in xrange(10):
-			if user.source not in Transport:
-				logger.debug("longpoll: while we were wasting our time"
-					", the user has left (jid: %s)", user.source)
+		error = None
+		if not opener.connected:
+			try:
+				events = opener.step()
+			except (httplib.HTTPException,) + api.ERRORS as e:
+				error = e
+			else:
 				with cls.__lock:
-					if user in cls.__buff:
-						cls.__buff.remove(user)
+					if fd in cls.__watched:
+						cls.__reactor.modify(fd, events)
+				return None
+		elif not mask & reactor.READ:
+			error = socket.error("The connection was closed")
+		with cls.__lock:
+			if fd not in cls.__watched:
 				return None
+			cls.__popWatched(fd)
+		if error and not opener.connected:
+			# the connection has failed in step(), it's closed after the socket is unregistered
+			opener.fail()
+		cls.workers.put(fd, callback, (opener, error))
 
-			if Transport[user.source].vk.initPoll():
-				with cls.__lock:
-					logger.debug("longpoll: successfully initialized longpoll"
-						" (jid: %s)", user.source)
-					if user not in cls.__buff:
-						return None
-					cls.__buff.remove(user)
-					# Check if user still in transport when we finally came down here
-					if user.source in Transport:
-						cls.__add(Transport[user.source])
-					break
-			time.sleep(10)
-		else:
+	@classmethod
+	def clear(cls):
+		with cls.__lock:
+			for fd in cls.__list.keys():
+				cls.__pop(fd)
+
+	@classmethod
+	def __initPoll(cls, user, attempt):
+		"""
+		Tries to reinitialize poll (executed by the scheduler)
+		Schedules the next attempt on failure (up to INIT_ATTEMPTS)
+		As soon as poll initialized user will be removed from buffer
+		"""
+		if user.source not in Transport:
+			logger.debug("longpoll: while we were wasting our time"
+				", the user has left (jid: %s)", user.source)
 			with cls.__lock:
+				cls.__buff.discard(user)
+			return None
+
+		# the attempts aren't wasted while VK is unavailable
+		delay = max(api.breakers.getDelay(api.API_URL),
+			api.breakers.getDelay(user.vk.pollServer or api.API_URL))
+		if delay:
+			cls.scheduler.schedule(delay + cls.getInitDelay(0), cls.__initPoll, (user, attempt))
+			return None
+
+		if Transport[user.source].vk.initPoll():
+			with cls.__lock:
+				logger.debug("longpoll: successfully initialized longpoll"
+					" (jid: %s)", user.source)
 				if user not in cls.__buff:
 					return None
 				cls.__buff.remove(user)
-			logger.error("longpoll: failed to add user to poll in 10 retries"
-				" (jid: %s)", user.source)
+			# Check if user still in transport when we finally came down here
+			if user.source in Transport:
+				cls.add(Transport[user.source])
+
+		elif (attempt + 1) < cls.INIT_ATTEMPTS:
+			delay = cls.getInitDelay(attempt + 1)
+			logger.debug("longpoll: next attempt to initialize longpoll in %0.1f seconds"
+				" (jid: %s)" % (delay, user.source))
+			cls.scheduler.schedule(delay, cls.__initPoll, (user, attempt + 1))
+
+		else:
+			with cls.__lock:
+				cls.__buff.discard(user)
+			logger.error("longpoll: failed to add user to poll in %d retries"
+				" (jid: %s)", cls.INIT_ATTEMPTS, user.source)
 
 	@classmethod
 	def process(cls):
 		"""
-		Processes poll sockets by select.select()
+		Processes poll sockets by the reactor (epoll, poll or select)
 		As soon as socket will be ready to be read
 			will be called user.processPollResult() function
 		Read processPollResult.__doc__ to learn more about status codes
 		"""
+		cls.workers.start()
+		cls.scheduler.start()
+		if Shards.enabled:
+			# the longpoll requests are made by the worker processes
+			# the reactor is still used for the non-blocking API requests
+			utils.runThread(Shards.receive, name="shards")
+		logger.debug("longpoll: using %s reactor", cls.__reactor.name)
+		lastCleanup = time.time()
 		while ALIVE:
-			socks = cls.__list.keys()
-			if not socks:
+			if not cls.__list and not cls.__watched:
 				time.sleep(0.02)
 				continue
 			try:
-				ready, error = select.select(socks, [], socks, 2)[::2]
-			except (select.error, socket.error, socket.timeout) as e:
-				logger.error("longpoll: %s", e.message)
+				events = cls.__reactor.poll(2)
+			except (select.error, socket.error, IOError, ValueError) as e:
+				logger.error("longpoll: %s", e)
+				time.sleep(0.02)
+				continue
 
-			for sock in error:
+			cls.iterations.mark()
+			ready = time.time()
+			for fd, mask in events:
 				with cls.__lock:
-					# We will just re-add the user to poll
-					# in case if anything weird happen to the socket
-					try:
-						cls.__add(cls.__list.pop(sock)[0])
-					except KeyError:
-						continue
+					entry = cls.__list.get(fd)
+					watched = cls.__watched.get(fd)
+				if watched:
+					cls.__stepWatched(fd, mask, *watched)
+					continue
+				if not entry:
+					continue
+
+				user, opener = entry
+				if not opener.connected:
+					cls.__step(fd, user, opener)
+					continue
 
-			for sock in ready:
 				with cls.__lock:
 					try:
-						user, opener = cls.__list.pop(sock)
+						cls.__pop(fd)
 					except KeyError:
 						continue
 
-					# Check if user is still in the memory
-					user = Transport.get(user.source)
-					# Check if the user haven't left yet
-					if not hasattr(user, "vk") or not user.vk.online:
-						continue
+				if not mask & reactor.READ:
+					# We will just re-add the user to poll
+					# in case if anything weird happen to the socket
+					opener.close()
+					cls.workers.put(user.source, cls.add, (user,))
+					continue
 
-					utils.runThread(cls.processResult, (user, opener),
-						"poll.processResult-%s" % user.source)
+				# Check if user is still in the memory
+				user = Transport.get(user.source)
+				# Check if the user haven't left yet
+				if not hasattr(user, "vk") or not user.vk.online:
+					continue
 
-			with cls.__lock:
-				for sock, (user, opener) in cls.__list.items():
-					if hasattr(user, "vk") and not user.vk.online:
-						logger.debug("longpoll: user is not online, so removing them from poll"
-							" (jid: %s)", user.source)
-						try:
-							del cls.__list[sock]
-						except KeyError:
-							pass
+				cls.workers.put(user.source, cls.processResult, (user, opener, ready))
+
+			# users are leaving rarely, so there is no need to check them on every wakeup
+			if (time.time() - lastCleanup) >= cls.CLEANUP_INTERVAL:
+				lastCleanup = time.time()
+				cls.cleanup()
 
 	@classmethod
-	def processResult(cls, user, opener):
+	def cleanup(cls):
+		"""
+		Removes the users who went offline from poll
+		Retries the connections which weren't made in time
+		"""
+		expired = []
+		with cls.__lock:
+			for fd, (user, opener) in cls.__list.items():
+				if hasattr(user, "vk") and not user.vk.online:
+					logger.debug("longpoll: user is not online, so removing them from poll"
+						" (jid: %s)", user.source)
+					cls.__pop(fd)
+					opener.close()
+
+				elif not opener.connected and time.time() > opener.deadline:
+					logger.warning("longpoll: connection timed out in state %s (jid: %s)",
+						opener.state, user.source)
+					cls.__pop(fd)
+					opener.fail()
+					expired.append((user, opener))
+
+			now = time.time()
+			for fd, (opener, callback) in cls.__watched.items():
+				# the response must be received in the timeout after the request is sent
+				if now > opener.deadline + (opener.timeout if opener.connected else 0):
+					cls.__popWatched(fd)
+					opener.fail()
+					cls.workers.put(fd, callback, (opener, socket.timeout("timed out")))
+		for user, opener in expired:
+			cls.workers.put(user.source, cls.__retry, (user, opener))
+
+	@classmethod
+	def processResult(cls, user, opener, ready):
 		"""
 		Processes the select result (see above)
 		Handles answers from user.processPollResult()
 		Decides if need to add user to poll or not
 		"""
 		result = utils.execute(user.processPollResult, (opener,))
+		cls.latency.observe((time.time() - ready) * 1000)
 		if DEBUG_POLL:
 			logger.debug("longpoll: result=%s (jid: %s)", result, user.source)
 		if result == -1:
@@ -185,4 +411,114 @@ class Poll:
 			user.vk.pollInitialzed = False
 		cls.add(user)
 
- 
+
+# the non-blocking API requests are made by Poll
+api.watch = Poll.watch
+api.schedule = Poll.scheduler.schedule
+
+metrics.gauge("poll/users", Poll.getUserCount, "users")
+metrics.gauge("poll/buffer", Poll.getWaitingCount, "users")
+metrics.gauge("poll/workers/queue", Poll.workers.getQueueDepth, "tasks")
+metrics.gauge("poll/delivery/queue", Poll.delivery.getQueueDepth, "tasks")
+metrics.gauge("poll/delivery/users", Poll.delivery.getKeyCount, "users")
+metrics.gauge("poll/workers/utilisation", Poll.workers.getUtilisation, "share")
+metrics.gauge("poll/handshakes", lambda: api.AsyncHTTPRequest.handshakes, "connections")
+metrics.gauge("poll/handshakes/avoided", lambda: api.AsyncHTTPRequest.handshakesAvoided, "connections")
+
+
+class Shards:
+	"""
+	Delegates longpoll to the worker processes (see library/shards.py)
+	A user is always served by the same process which is chosen by a hash of their jid
+	The events are processed here by Poll.workers, same as in the single-process mode
+	"""
+	__conns = []
+	__lock = threading._allocate_lock()
+	enabled = False
+
+	@classmethod
+	def start(cls, count):
+		"""
+		Starts the worker processes
+		Must be called before any thread or connection is made,
+			so the processes won't inherit them
+		"""
+		import shards
+		pipes = [multiprocessing.Pipe() for x in xrange(count)]
+		mine = [parent for parent, child in pipes]
+		for number, (parent, child) in enumerate(pipes):
+			inherited = mine + [other for x, other in pipes if other is not child]
+			process = multiprocessing.Process(target=shards.run, args=(number, child, inherited),
+				name="shard%d" % number)
+			process.daemon = True
+			process.start()
+		for parent, child in pipes:
+			child.close()
+			# the workers must see the pipe closed if the transport is restarted by exec()
+			flags = fcntl.fcntl(parent.fileno(), fcntl.F_GETFD)
+			fcntl.fcntl(parent.fileno(), fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+		cls.__conns = [(conn, threading._allocate_lock()) for conn in mine]
+		cls.enabled = True
+		logger.info("longpoll: started %d worker processes", count)
+
+	@classmethod
+	def send(cls, jid, *message):
+		conn, lock = cls.__conns[zlib.crc32(jid) % len(cls.__conns)]
+		with lock:
+			conn.send(message)
+
+	@classmethod
+	def add(cls, user):
+		vk = user.vk
+		server = vk.pollServer if vk.pollInitialzed else None
+		cls.send(user.source, "add", user.source, vk.engine.token, server, vk.pollConfig)
+
+	@classmethod
+	def remove(cls, jid):
+		cls.send(jid, "remove", jid)
+
+	@classmethod
+	def receive(cls):
+		"""
+		Receives the events from the worker processes
+		"""
+		for number, (conn, lock) in enumerate(cls.__conns[1:], 1):
+			utils.runThread(cls.receiveFrom, (conn,), "shard%d.receiver" % number)
+		cls.receiveFrom(cls.__conns[0][0])
+
+	@classmethod
+	def receiveFrom(cls, conn):
+		while ALIVE:
+			try:
+				message = conn.recv()
+			except (EOFError, IOError):
+				logger.critical("longpoll: a worker process has gone")
+				crashLog("shards.receive")
+				break
+			command, jid = message[:2]
+			Poll.workers.put(jid, cls.handle, (time.time(), command, jid) + message[2:])
+
+	@classmethod
+	def handle(cls, ready, command, jid, *args):
+		"""
+		Handles a message from a worker process (executed by Poll.workers)
+		"""
+		user = Transport.get(jid)
+		if not hasattr(user, "vk") or not user.vk.online:
+			# the user is removed from the worker lazily
+			logger.debug("longpoll: user is not online, so removing them from poll"
+				" (jid: %s)", jid)
+			return cls.remove(jid)
+
+		if command == "init":
+			user.vk.setPollServer(*args)
+
+		elif command == "data":
+			if user.vk.engine.captcha:
+				return cls.remove(jid)
+			user.processPollData(*args)
+			Poll.latency.observe((time.time() - ready) * 1000)
+
+		elif command == "failed":
+			user.vk.pollInitialzed = False
+			logger.error("longpoll: failed to add user to poll (jid: %s)", jid)
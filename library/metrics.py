@@ -0,0 +1,189 @@
+# coding: utf-8
+# This file is a part of VK4XMPP transport
+# © simpleApps, 2015.
+
+"""
+Contains counters, meters and histograms
+All of them are kept in a registry, so they can be read by the stats handler
+Each metric is read as a list of (name, value, units) tuples
+"""
+
+__author__ = "mrDoctorWho <mrdoctorwho@gmail.com>"
+
+import bisect
+import threading
+import time
+
+registry = {}
+registryLock = threading._allocate_lock()
+
+# histogram buckets in milliseconds
+LATENCY_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+
+class Counter(object):
+	"""
+	A value which only grows
+	"""
+	def __init__(self, name, units):
+		self.name = name
+		self.units = units
+		self.value = 0
+		self.lock = threading._allocate_lock()
+
+	def inc(self, count=1):
+		with self.lock:
+			self.value += count
+
+	def read(self):
+		return [(self.name, self.value, self.units)]
+
+
+class Gauge(object):
+	"""
+	A value which is taken from a function when it's read
+	"""
+	def __init__(self, name, units, func):
+		self.name = name
+		self.units = units
+		self.func = func
+
+	def read(self):
+		try:
+			value = self.func()
+		except Exception:
+			value = None
+		if isinstance(value, float):
+			value = "%0.2f" % value
+		return [(self.name, value, self.units)]
+
+
+class Meter(object):
+	"""
+	Counts events per second
+	The rate is calculated for the last complete interval
+	"""
+	def __init__(self, name, units, interval=10):
+		self.name = name
+		self.units = units
+		self.interval = interval
+		self.count = 0
+		self.total = 0
+		self.rate = 0.0
+		self.start = time.time()
+		self.lock = threading._allocate_lock()
+
+	def mark(self, count=1):
+		with self.lock:
+			self.count += count
+			self.total += count
+			self.tick()
+
+	def tick(self):
+		now = time.time()
+		elapsed = now - self.start
+		if elapsed >= self.interval:
+			self.rate = self.count / elapsed
+			self.count = 0
+			self.start = now
+
+	def read(self):
+		with self.lock:
+			self.tick()
+			return [(self.name, "%0.2f" % self.rate, "%s/s" % self.units),
+				(self.name + "/total", self.total, self.units)]
+
+
+class Histogram(object):
+	"""
+	Counts values by buckets
+	The percentiles are estimated by the bucket bounds
+	"""
+	def __init__(self, name, units, buckets):
+		self.name = name
+		self.units = units
+		self.buckets = tuple(buckets)
+		self.lock = threading._allocate_lock()
+		self.reset()
+
+	def reset(self):
+		self.counts = [0] * (len(self.buckets) + 1)
+		self.count = 0
+		self.sum = 0
+		self.max = 0
+
+	def observe(self, value):
+		with self.lock:
+			self.counts[bisect.bisect_left(self.buckets, value)] += 1
+			self.count += 1
+			self.sum += value
+			self.max = max(self.max, value)
+
+	def percentile(self, share):
+		"""
+		Returns the upper bound of the bucket the percentile falls into
+		Must be called under the lock
+		"""
+		if not self.count:
+			return 0
+		needed = self.count * share
+		seen = 0
+		for num, count in enumerate(self.counts):
+			seen += count
+			if seen >= needed:
+				if num < len(self.buckets):
+					return min(self.buckets[num], self.max)
+				break
+		return self.max
+
+	def read(self):
+		with self.lock:
+			avg = (float(self.sum) / self.count) if self.count else 0.0
+			values = [("avg", avg), ("p50", self.percentile(0.5)),
+				("p95", self.percentile(0.95)), ("p99", self.percentile(0.99)),
+				("max", self.max)]
+		result = [(self.name + "/count", self.count, "times")]
+		for key, value in values:
+			if isinstance(value, float):
+				value = "%0.2f" % value
+			result.append(("%s/%s" % (self.name, key), value, self.units))
+		return result
+
+
+def register(metric):
+	"""
+	Adds the metric to the registry
+	Returns the metric which was already registered with the same name if any
+	"""
+	with registryLock:
+		return registry.setdefault(metric.name, metric)
+
+
+def counter(name, units="times"):
+	return register(Counter(name, units))
+
+
+def gauge(name, func, units="items"):
+	return register(Gauge(name, units, func))
+
+
+def meter(name, units="times"):
+	return register(Meter(name, units))
+
+
+def histogram(name, units="ms", buckets=LATENCY_BUCKETS):
+	return register(Histogram(name, units, buckets))
+
+
+def read(prefix=""):
+	"""
+	Returns a list of (name, value, units) tuples for all the metrics
+		whose names start with the prefix
+	"""
+	with registryLock:
+		metrics = sorted(registry.items())
+	values = []
+	for name, metric in metrics:
+		if name.startswith(prefix):
+			values.extend(metric.read())
+	return values
@@ -0,0 +1,187 @@
+# coding: utf-8
+# This file is a part of VK4XMPP transport
+# © simpleApps, 2015.
+
+"""
+Contains the profile cache shared by all users
+Users' and groups' public fields are kept once for the whole transport,
+	the fields which depend on who is asking are kept by each user separately
+"""
+
+__author__ = "mrDoctorWho <mrdoctorwho@gmail.com>"
+
+import sys
+import threading
+import time
+import metrics
+from collections import OrderedDict
+
+# the fields which are always returned by users.get and groups.getById
+BASE_FIELDS = {"user": ("first_name", "last_name", "name"),
+	"group": ("name",)}
+
+# max ids for one users.get or groups.getById call
+MAX_IDS = {"user": 1000, "group": 500}
+
+# the fields whose values depend on the user who requested them
+VIEWER_FIELDS = {"user": ("is_friend", "friend_status", "can_write_private_message",
+		"can_send_friend_request", "can_post", "can_see_all_posts", "can_see_audio",
+		"blacklisted", "blacklisted_by_me", "is_favorite", "is_hidden_from_feed", "common_count"),
+	"group": ("is_member", "is_admin", "admin_level", "is_advertiser", "member_status",
+		"can_post", "can_see_all_posts", "can_message", "can_create_topic", "is_favorite")}
+
+
+class Entry(object):
+	"""
+	A cached profile
+	"""
+	def __init__(self):
+		self.data = {}
+		self.updated = {}
+		self.size = 0
+
+	def getSize(self):
+		size = sys.getsizeof(self.data)
+		for key, value in self.data.iteritems():
+			size += sys.getsizeof(key) + sys.getsizeof(value)
+		return size
+
+
+class ProfileCache(object):
+	"""
+	Keeps profiles in LRU order
+	Each field expires after ttl seconds, so a profile is updated only by the fields which were requested
+	The least recently used profiles are removed when there are too many of them
+		or they take too much memory
+	"""
+	def __init__(self, ttl=3600, size=50000, memory=32):
+		self.entries = OrderedDict()
+		self.lock = threading._allocate_lock()
+		self.memoryUsed = 0
+		self.configure(ttl, size, memory)
+		self.hits = metrics.counter("profiles/hits", "requests")
+		self.misses = metrics.counter("profiles/misses", "requests")
+		self.evictions = metrics.counter("profiles/evictions", "profiles")
+		metrics.gauge("profiles/count", lambda: len(self.entries), "profiles")
+		metrics.gauge("profiles/memory", lambda: self.memoryUsed / 1048576.0, "MB")
+		metrics.gauge("profiles/hitrate", self.getHitRate, "share")
+
+	def configure(self, ttl, size, memory):
+		"""
+		Parameters:
+			ttl: how long (in seconds) a field is kept
+			size: max number of profiles
+			memory: max memory (in megabytes) the profiles can take
+		"""
+		self.ttl = ttl
+		self.size = size
+		self.memory = memory * 1048576
+
+	def getHitRate(self):
+		total = self.hits.value + self.misses.value
+		if not total:
+			return 0.0
+		return float(self.hits.value) / total
+
+	def lookup(self, key, fields, now):
+		"""
+		Returns a tuple of (data, missing fields)
+		Must be called under the lock
+		"""
+		entry = self.entries.pop(key, None)
+		if not entry:
+			return ({}, list(fields))
+		self.entries[key] = entry
+		missing = []
+		for field in fields:
+			if (now - entry.updated.get(field, 0)) > self.ttl:
+				missing.append(field)
+		return (entry.data, missing)
+
+	def store(self, key, fields, data, now):
+		"""
+		Merges the fetched fields into the profile
+		The fields which weren't returned are stored as missing, so they won't be requested again
+		"""
+		with self.lock:
+			entry = self.entries.pop(key, None) or Entry()
+			self.memoryUsed -= entry.size
+			for field in fields:
+				entry.updated[field] = now
+				if field in data:
+					entry.data[field] = data[field]
+				else:
+					entry.data.pop(field, None)
+			entry.size = entry.getSize()
+			self.memoryUsed += entry.size
+			self.entries[key] = entry
+			while self.entries and (len(self.entries) > self.size or self.memoryUsed > self.memory):
+				key, entry = self.entries.popitem(last=False)
+				self.memoryUsed -= entry.size
+				self.evictions.inc()
+
+	def get(self, kind, id, fields, fetch, local):
+		"""
+		Returns the profile with the requested fields or an empty dict if it couldn't be fetched
+		Parameters are the same as in getMany() except id
+		"""
+		return self.getMany(kind, [id], fields, fetch, local).get(id, {})
+
+	def getMany(self, kind, ids, fields, fetch, local):
+		"""
+		Returns a dict of {id: profile} with the requested fields (keyed by the ids as they were passed)
+		Only the missing fields are fetched, the missing profiles are fetched together
+			by one request for each MAX_IDS of them
+		The profiles which couldn't be fetched are not returned
+		Parameters:
+			kind: "user" or "group"
+			ids: user or group ids (VK returns them as int, but str is accepted too)
+			fields: the fields needed
+			fetch: function(ids, fields) returning a list of profiles from VK
+			local: the dict where the viewer-dependent fields are kept
+		"""
+		keys = {}
+		for key in ids:
+			try:
+				keys[key] = int(key)
+			except (TypeError, ValueError):
+				continue
+		ids = keys.values()
+		fields = set(fields) | set(BASE_FIELDS[kind])
+		viewerFields = set([field for field in fields if field in VIEWER_FIELDS[kind]])
+		fields -= viewerFields
+		now = time.time()
+		result, wanted, missing = {}, [], set()
+		with self.lock:
+			for id in set(ids):
+				data, absent = self.lookup((kind, id), fields, now)
+				result[id] = dict(data)
+				absent += [field for field in viewerFields if field not in local.get((kind, id), {})]
+				if absent:
+					wanted.append(id)
+					missing.update(absent)
+		self.hits.inc(len(result) - len(wanted))
+		self.misses.inc(len(wanted))
+		if wanted:
+			shared = [field for field in missing if field not in viewerFields]
+			requested = [field for field in missing if field not in BASE_FIELDS[kind]]
+			fetched = set()
+			for start in xrange(0, len(wanted), MAX_IDS[kind]):
+				for data in fetch(wanted[start:start + MAX_IDS[kind]], requested) or ():
+					id = data.pop("id", None)
+					if id not in result:
+						continue
+					fetched.add(id)
+					self.store((kind, id), shared, data, now)
+					cached = local.setdefault((kind, id), {})
+					for field in viewerFields:
+						if field in data:
+							cached[field] = data[field]
+					result[id].update(data)
+			for id in set(wanted) - fetched:
+				del result[id]
+		for id, data in result.iteritems():
+			data.update(local.get((kind, id), {}))
+		return dict((key, result[id]) for key, id in keys.iteritems() if id in result)
+
+cache = ProfileCache()
@@ -0,0 +1,167 @@
+# coding: utf-8
+# This file is a part of VK4XMPP transport
+# © simpleApps, 2015.
+
+"""
+Provides a common interface to epoll, poll and select
+Sockets are registered once and each wakeup returns only the ready ones
+"""
+
+__author__ = "mrDoctorWho <mrdoctorwho@gmail.com>"
+
+import errno
+import select
+
+READ = 1
+WRITE = 2
+ERROR = 4
+
+
+class SelectReactor(object):
+	"""
+	The fallback for systems which have neither epoll nor poll
+	Limited by FD_SETSIZE (usually 1024 descriptors)
+	"""
+	name = "select"
+
+	def __init__(self):
+		self.fds = {}
+
+	def register(self, fd, events=READ):
+		self.fds[fd] = events
+
+	modify = register
+
+	def unregister(self, fd):
+		self.fds.pop(fd, None)
+
+	def __len__(self):
+		return len(self.fds)
+
+	def poll(self, timeout=None):
+		"""
+		Waits for events
+		Returns a list of (fd, events) tuples
+		"""
+		fds = self.fds.items()
+		rlist = [fd for fd, events in fds if events & READ]
+		wlist = [fd for fd, events in fds if events & WRITE]
+		allfds = [fd for fd, events in fds]
+		try:
+			r, w, x = select.select(rlist, wlist, allfds, timeout)
+		except select.error as e:
+			if e.args[0] == errno.EINTR:
+				return []
+			raise
+		result = {}
+		for fd in r:
+			result[fd] = READ
+		for fd in w:
+			result[fd] = result.get(fd, 0) | WRITE
+		for fd in x:
+			result[fd] = result.get(fd, 0) | ERROR
+		return result.items()
+
+
+class PollReactor(object):
+	"""
+	Uses poll(2), has no descriptor limit but every call is still O(n)
+	"""
+	name = "poll"
+	IN = select.POLLIN | getattr(select, "POLLPRI", 0)
+	OUT = select.POLLOUT
+	ERR = select.POLLERR | select.POLLHUP | select.POLLNVAL
+
+	def __init__(self):
+		self.fds = {}
+		self.engine = self.createEngine()
+
+	createEngine = staticmethod(lambda: select.poll())
+
+	def translate(self, events):
+		mask = 0
+		if events & READ:
+			mask |= self.IN
+		if events & WRITE:
+			mask |= self.OUT
+		return mask
+
+	def register(self, fd, events=READ):
+		if fd in self.fds:
+			return self.modify(fd, events)
+		self.engine.register(fd, self.translate(events))
+		self.fds[fd] = events
+
+	def modify(self, fd, events):
+		if fd not in self.fds:
+			return self.register(fd, events)
+		self.engine.modify(fd, self.translate(events))
+		self.fds[fd] = events
+
+	def unregister(self, fd):
+		if self.fds.pop(fd, None) is not None:
+			try:
+				self.engine.unregister(fd)
+			except (IOError, OSError, KeyError, ValueError):
+				# the descriptor has probably been closed already
+				pass
+
+	def __len__(self):
+		return len(self.fds)
+
+	def wait(self, timeout):
+		if timeout is not None:
+			timeout *= 1000
+		return self.engine.poll(timeout)
+
+	def poll(self, timeout=None):
+		"""
+		Waits for events
+		Returns a list of (fd, events) tuples
+		"""
+		try:
+			ready = self.wait(timeout)
+		except (select.error, IOError) as e:
+			if e.args[0] == errno.EINTR:
+				return []
+			raise
+		result = []
+		for fd, mask in ready:
+			events = 0
+			if mask & self.IN:
+				events |= READ
+			if mask & self.OUT:
+				events |= WRITE
+			if mask & self.ERR:
+				events |= ERROR
+			result.append((fd, events))
+		return result
+
+
+if hasattr(select, "epoll"):
+	class EpollReactor(PollReactor):
+		"""
+		Uses epoll(7): a wakeup costs O(ready sockets)
+		"""
+		name = "epoll"
+		IN = select.EPOLLIN | select.EPOLLPRI
+		OUT = select.EPOLLOUT
+		ERR = select.EPOLLERR | select.EPOLLHUP
+
+		createEngine = staticmethod(lambda: select.epoll())
+
+		def wait(self, timeout):
+			if timeout is None:
+				timeout = -1
+			return self.engine.poll(timeout)
+
+	Reactor = EpollReactor
+
+elif hasattr(select, "poll"):
+	Reactor = PollReactor
+
+else:
+	Reactor = SelectReactor
+
+
+BACKENDS = dict((cls.name, cls) for cls in set([SelectReactor, PollReactor, Reactor]))
@@ -0,0 +1,83 @@
+# coding: utf-8
+# This file is a part of VK4XMPP transport
+# © simpleApps, 2015.
+
+"""
+Contains the registry of the users kept in the database
+The users table is loaded once at startup, the registry is updated along with the table
+	so the users can be found and counted without querying the database
+"""
+
+__author__ = "mrDoctorWho <mrdoctorwho@gmail.com>"
+
+import threading
+import metrics
+
+# the columns of the users table in the order they're returned by get()
+COLUMNS = ("jid", "username", "token", "lastMsgID", "rosterSet",
+	"pollServer", "pollKey", "pollTs", "pollPts")
+
+
+class UserRegistry(object):
+	"""
+	Keeps the users' rows by their jids
+	"""
+	def __init__(self):
+		self.rows = {}
+		self.lock = threading._allocate_lock()
+		metrics.gauge("users/registered", self.count, "users")
+
+	def load(self, rows):
+		"""
+		Replaces the registry with the rows (they must have all the columns)
+		"""
+		with self.lock:
+			self.rows = dict([(row[0], list(row)) for row in rows])
+
+	def get(self, jid):
+		"""
+		Returns the user's row as a tuple or None if the user isn't registered
+		"""
+		with self.lock:
+			row = self.rows.get(jid)
+			if row:
+				return tuple(row)
+
+	def add(self, jid, **fields):
+		"""
+		Adds the user, the missing fields are None
+		"""
+		row = [None] * len(COLUMNS)
+		row[0] = jid
+		with self.lock:
+			self.rows[jid] = row
+			self.set(row, fields)
+
+	def update(self, jid, **fields):
+		"""
+		Updates the fields of the user if they're registered
+		"""
+		with self.lock:
+			row = self.rows.get(jid)
+			if row:
+				self.set(row, fields)
+
+	def set(self, row, fields):
+		for name, value in fields.iteritems():
+			row[COLUMNS.index(name)] = value
+
+	def remove(self, jid):
+		with self.lock:
+			self.rows.pop(jid, None)
+
+	def count(self):
+		return len(self.rows)
+
+	def getJids(self):
+		with self.lock:
+			return self.rows.keys()
+
+	__contains__ = lambda self, jid: jid in self.rows
+
+
+users = UserRegistry()
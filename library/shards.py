@@ -0,0 +1,345 @@
+# coding: utf-8
+# This file is a part of VK4XMPP transport
+# © simpleApps, 2015.
+
+"""
+Implements the longpoll worker process (see LONGPOLL_SHARDS)
+Each process owns the users whose jid hash points to it,
+	makes their longpoll requests, decodes the responses
+	and sends the events to the process which holds the XMPP connection
+Messages from the main process:
+	("add", jid, token, server, config): start (or restart) polling for the user
+		the poll is initialized by the worker itself if server is None
+	("remove", jid): stop polling for the user
+Messages to the main process:
+	("init", jid, response): messages.getLongPollServer response
+	("data", jid, data): decoded longpoll response
+	("failed", jid): the poll couldn't be initialized
+"""
+
+__author__ = "mrDoctorWho <mrdoctorwho@gmail.com>"
+
+import httplib
+import os
+import signal
+import socket
+import threading
+import time
+import reactor
+import select
+import utils
+import vkapi as api
+from longpoll import Poll
+from __main__ import logger, DEBUG_POLL, LONGPOLL_WORKERS, LONGPOLL_INIT_CONCURRENCY, crashLog
+
+# vkapi.json is ujson if it's installed
+json = api.json
+
+
+class Shard(object):
+	"""
+	The longpoll loop of a worker process
+	"""
+	def __init__(self, number, conn):
+		self.number = number
+		self.conn = conn
+		self.users = {}
+		self.fds = {}
+		self.lock = threading.Lock()
+		self.sendLock = threading.Lock()
+		self.reactor = reactor.Reactor()
+		self.scheduler = utils.Scheduler(LONGPOLL_INIT_CONCURRENCY, "shard%d.init" % number)
+		# the responses are read and the connections are made by the workers,
+		# so a slow user or a DNS stall doesn't hold the reactor
+		self.workers = utils.WorkerPool(LONGPOLL_WORKERS, "shard%d.worker" % number)
+
+	def send(self, *message):
+		"""
+		Sends a message to the main process
+		Exits if the main process has gone
+		"""
+		with self.sendLock:
+			try:
+				self.conn.send(message)
+			except (IOError, EOFError):
+				logger.debug("shard%d: the main process has gone, exiting", self.number)
+				os._exit(0)
+
+	def add(self, jid, token, server, config):
+		with self.lock:
+			self.remove(jid)
+			self.users[jid] = {"token": token, "server": server,
+				"config": dict(config), "opener": None, "fd": None, "engine": None}
+		if server:
+			self.workers.put(jid, self.connect, (jid,))
+		else:
+			self.initPoll(jid, 0)
+
+	def remove(self, jid):
+		"""
+		Forgets the user and closes their connection
+		Must be called under the lock
+		"""
+		user = self.users.pop(jid, None)
+		if user and user["opener"]:
+			self.unregister(user)
+			user["opener"].close()
+
+	def register(self, jid, user, opener):
+		"""
+		Registers the opener's socket in the reactor
+		Must be called under the lock
+		"""
+		fd = opener.sock.fileno()
+		user["fd"] = fd
+		self.fds[fd] = jid
+		self.reactor.register(fd, (reactor.READ if opener.connected else reactor.WRITE))
+
+	def unregister(self, user):
+		"""
+		Removes the user's socket from the reactor
+		The socket may be closed already, so its descriptor is stored
+		Must be called under the lock
+		"""
+		fd = user.pop("fd", None)
+		if fd is not None:
+			self.reactor.unregister(fd)
+			self.fds.pop(fd, None)
+
+	def connect(self, jid):
+		"""
+		Starts the next longpoll request for the user (executed by the workers)
+		The connection is started out of the lock as the address resolution may block
+		"""
+		with self.lock:
+			user = self.users.get(jid)
+			if not user:
+				return None
+			server, config, opener = user["server"], dict(user["config"]), user["opener"]
+		try:
+			opener = api.AsyncHTTPRequest.getOpener(server, config, opener)
+		except api.ERRORS as e:
+			logger.error("shard%d: failed to make poll: %s (jid: %s)", self.number, e, jid)
+			opener = None
+		with self.lock:
+			if self.users.get(jid) is not user:
+				# the user was removed or added again meanwhile
+				if opener:
+					opener.close()
+				return None
+			user["opener"] = opener
+			if opener:
+				self.register(jid, user, opener)
+				return None
+		self.initPoll(jid, 0)
+
+	def retry(self, jid, opener):
+		"""
+		Connects again after the connection has failed
+		Or initializes the poll if there are no more attempts left
+		"""
+		if opener.attempts < api.REQUEST_RETRIES:
+			self.connect(jid)
+		else:
+			logger.error("shard%d: failed to connect in %d attempts (jid: %s)",
+				self.number, opener.attempts, jid)
+			self.initPoll(jid, 0)
+
+	def initPoll(self, jid, attempt):
+		delay = Poll.getInitDelay(attempt) if attempt else 0
+		self.scheduler.schedule(delay, self.requestServer, (jid, attempt))
+
+	def requestServer(self, jid, attempt):
+		"""
+		Calls messages.getLongPollServer (executed by the scheduler)
+		Schedules the next attempt on failure (up to Poll.INIT_ATTEMPTS)
+		"""
+		with self.lock:
+			user = self.users.get(jid)
+			if not user:
+				return None
+			if not user["engine"]:
+				user["engine"] = api.APIBinding(user["token"], logline=jid)
+			engine = user["engine"]
+			# the attempts aren't wasted while VK is unavailable
+			delay = max(api.breakers.getDelay(api.API_URL),
+				api.breakers.getDelay(user["server"] or api.API_URL))
+		if delay:
+			return self.scheduler.schedule(delay + Poll.getInitDelay(0),
+				self.requestServer, (jid, attempt))
+		logger.debug("shard%d: requesting server address (jid: %s)", self.number, jid)
+		try:
+			response = engine.method("messages.getLongPollServer", {"use_ssl": 1, "need_pts": 1})
+		except Exception as e:
+			logger.warning("shard%d: unable to get server address: %s (jid: %s)",
+				self.number, e, jid)
+			response = None
+		if response and "server" in response:
+			with self.lock:
+				if self.users.get(jid) is not user:
+					return None
+				user["server"] = response["server"]
+				if "://" not in user["server"]:
+					user["server"] = "https://%s" % user["server"]
+				user["config"].update(key=response["key"], ts=response["ts"])
+			self.send("init", jid, response)
+			self.connect(jid)
+		elif (attempt + 1) < Poll.INIT_ATTEMPTS:
+			self.initPoll(jid, attempt + 1)
+		else:
+			logger.error("shard%d: failed to initialize poll in %d retries (jid: %s)",
+				self.number, Poll.INIT_ATTEMPTS, jid)
+			with self.lock:
+				self.remove(jid)
+			self.send("failed", jid)
+
+	def step(self, jid, user, opener):
+		"""
+		Moves the opener's connection to the next state
+		"""
+		try:
+			events = opener.step()
+		except (httplib.HTTPException,) + api.ERRORS as e:
+			logger.warning("shard%d: connection failed: %s (jid: %s)", self.number, e, jid)
+			with self.lock:
+				self.unregister(user)
+			opener.fail()
+			self.workers.put(jid, self.retry, (jid, opener))
+		else:
+			with self.lock:
+				if user.get("fd") is not None:
+					self.reactor.modify(user["fd"], events)
+
+	def process(self, jid, opener):
+		"""
+		Reads and decodes the response, sends it to the main process
+		"""
+		try:
+			data = json.loads(opener.read())
+		except (httplib.HTTPException, socket.error, socket.timeout) as e:
+			if opener.reused:
+				return self.connect(jid)
+			logger.warning("shard%d: got error `%s` (jid: %s)", self.number,
+				e.__class__.__name__, jid)
+			return self.initPoll(jid, 0)
+		except ValueError:
+			logger.error("shard%d: no data. Gonna request again (jid: %s)", self.number, jid)
+			return self.connect(jid)
+
+		if not data or "failed" in data:
+			logger.debug("shard%d: failed. Searching for a new server (jid: %s)",
+				self.number, jid)
+			return self.initPoll(jid, 0)
+
+		with self.lock:
+			user = self.users.get(jid)
+			if not user:
+				return None
+			user["config"]["ts"] = data["ts"]
+		if DEBUG_POLL:
+			logger.debug("shard%d: got %d updates (jid: %s)", self.number,
+				len(data.get("updates", ())), jid)
+		# the next request is sent before the main process gets the events
+		self.connect(jid)
+		self.send("data", jid, data)
+
+	def cleanup(self):
+		"""
+		Retries the connections which weren't made in time
+		"""
+		expired = []
+		with self.lock:
+			for jid, user in self.users.iteritems():
+				opener = user["opener"]
+				if opener and not opener.connected and time.time() > opener.deadline:
+					logger.warning("shard%d: connection timed out in state %s (jid: %s)",
+						self.number, opener.state, jid)
+					self.unregister(user)
+					opener.fail()
+					expired.append((jid, opener))
+		for jid, opener in expired:
+			self.workers.put(jid, self.retry, (jid, opener))
+
+	def receive(self):
+		"""
+		Handles the messages from the main process
+		Returns False if the main process has gone
+		"""
+		while True:
+			try:
+				if not self.conn.poll():
+					break
+				message = self.conn.recv()
+			except (EOFError, IOError):
+				return False
+			command, jid = message[:2]
+			if command == "add":
+				self.add(*message[1:])
+			elif command == "remove":
+				with self.lock:
+					self.remove(jid)
+		return True
+
+	def run(self):
+		self.scheduler.start()
+		self.workers.start()
+		pipe = self.conn.fileno()
+		self.reactor.register(pipe, reactor.READ)
+		lastCleanup = time.time()
+		while True:
+			try:
+				events = self.reactor.poll(2)
+			except (select.error, socket.error, IOError, ValueError) as e:
+				logger.error("shard%d: %s", self.number, e)
+				time.sleep(0.02)
+				continue
+
+			for fd, mask in events:
+				if fd == pipe:
+					if not self.receive():
+						return None
+					continue
+				with self.lock:
+					jid = self.fds.get(fd)
+					user = self.users.get(jid)
+					if not user or not user["opener"]:
+						continue
+					opener = user["opener"]
+				if not opener.connected:
+					self.step(jid, user, opener)
+					continue
+
+				with self.lock:
+					self.unregister(user)
+				if not mask & reactor.READ:
+					opener.close()
+					self.workers.put(jid, self.connect, (jid,))
+					continue
+				self.workers.put(jid, self.process, (jid, opener))
+
+			if (time.time() - lastCleanup) >= Poll.CLEANUP_INTERVAL:
+				lastCleanup = time.time()
+				self.cleanup()
+
+
+def run(number, conn, inherited):
+	"""
+	The worker process entry point
+	Parameters:
+		number: the shard number
+		conn: the worker's end of the pipe
+		inherited: the pipe ends which belong to the other processes
+	"""
+	# the main process handles the signals and the worker exits when the pipe is closed
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	signal.signal(signal.SIGTERM, signal.SIG_DFL)
+	for other in inherited:
+		other.close()
+	logger.debug("shard%d: started (pid: %d)", number, os.getpid())
+	try:
+		Shard(number, conn).run()
+		logger.debug("shard%d: the main process has gone, exiting", number)
+	except Exception:
+		crashLog("shard.run")
+	finally:
+		os._exit(0)
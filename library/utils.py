@@ -6,6 +6,9 @@
 Contains useful functions which used across the modules
 """
 
+import heapq
+import itertools
+import Queue
 import threading
 import time
 import xmpp
@@ -62,6 +65,180 @@ def runThread(func, args=(), name=None, att=3, delay=0):
 	return thr
 
 
+class WorkerPool(object):
+	"""
+	A fixed-size pool of worker threads
+	Each worker owns a queue and tasks are distributed by a key,
+		so the tasks with the same key are always executed
+		by the same worker in the same order they were put
+	"""
+	def __init__(self, size, name="worker"):
+		self.size = max(int(size), 1)
+		self.name = name
+		self.queues = [Queue.Queue() for x in xrange(self.size)]
+		self.lock = threading._allocate_lock()
+		self.started = False
+		# counters
+		self.busy = 0
+		self.busyTime = 0.0
+		self.processed = 0
+		self.startTime = time.time()
+
+	def start(self):
+		"""
+		Starts the workers (only once)
+		"""
+		with self.lock:
+			if self.started:
+				return None
+			self.started = True
+			self.startTime = time.time()
+		for num, queue in enumerate(self.queues):
+			runThread(self.__work, (queue,), "%s-%d" % (self.name, num))
+
+	def put(self, key, func, args=()):
+		"""
+		Puts a task in the queue of the worker which owns the key
+		Parameters:
+			key: any hashable object (e.g. user's jid)
+			func: function to execute
+			args: function arguments
+		"""
+		self.queues[hash(key) % self.size].put((func, args))
+
+	def __work(self, queue):
+		while True:
+			func, args = queue.get()
+			start = time.time()
+			with self.lock:
+				self.busy += 1
+			execute(func, args)
+			with self.lock:
+				self.busy -= 1
+				self.processed += 1
+				self.busyTime += time.time() - start
+
+	def getQueueDepth(self):
+		"""
+		Returns the number of tasks waiting in all queues
+		"""
+		return sum([queue.qsize() for queue in self.queues])
+
+	def getUtilisation(self):
+		"""
+		Returns the share of time the workers spent executing tasks
+		since the pool was started (from 0 to 1)
+		"""
+		elapsed = (time.time() - self.startTime) * self.size
+		if not elapsed:
+			return 0.0
+		return min(self.busyTime / elapsed, 1.0)
+
+
+class SerialQueue(object):
+	"""
+	Executes the tasks with the same key one by one in the order they were put
+	Each key which has tasks waiting is served by its own thread,
+		so a slow task doesn't hold the tasks of the other keys
+	The thread exits as soon as there are no more tasks for its key
+	"""
+	def __init__(self, name="serial"):
+		self.name = name
+		self.queues = {}
+		self.lock = threading._allocate_lock()
+
+	def put(self, key, func, args=()):
+		"""
+		Puts a task in the key's queue
+		Parameters are the same as WorkerPool.put() has
+		"""
+		with self.lock:
+			queue = self.queues.get(key)
+			if queue is not None:
+				queue.append((func, args))
+				return None
+			self.queues[key] = queue = [(func, args)]
+		runThread(self.__work, (key, queue), "%s-%s" % (self.name, key))
+
+	def __work(self, key, queue):
+		while True:
+			with self.lock:
+				if not queue:
+					del self.queues[key]
+					return None
+				func, args = queue.pop(0)
+			execute(func, args)
+
+	def getQueueDepth(self):
+		"""
+		Returns the number of tasks waiting in all queues
+		"""
+		with self.lock:
+			return sum([len(queue) for queue in self.queues.itervalues()])
+
+	def getKeyCount(self):
+		"""
+		Returns the number of keys being served
+		"""
+		return len(self.queues)
+
+
+class Scheduler(object):
+	"""
+	Executes delayed tasks by a fixed number of threads
+	The number of threads limits how many tasks are being executed at once
+	Tasks are kept in a heap ordered by the time they should be executed at
+	"""
+	def __init__(self, size, name="scheduler"):
+		self.size = max(int(size), 1)
+		self.name = name
+		self.heap = []
+		self.cond = threading.Condition(threading.Lock())
+		self.counter = itertools.count()
+		self.started = False
+		self.running = 0
+
+	def start(self):
+		"""
+		Starts the threads (only once)
+		"""
+		with self.cond:
+			if self.started:
+				return None
+			self.started = True
+		for num in xrange(self.size):
+			runThread(self.__work, (), "%s-%d" % (self.name, num))
+
+	def schedule(self, delay, func, args=()):
+		"""
+		Schedules func(*args) to be executed in delay seconds
+		"""
+		with self.cond:
+			heapq.heappush(self.heap, (time.time() + delay, self.counter.next(), func, args))
+			self.cond.notify()
+
+	def __work(self):
+		while True:
+			with self.cond:
+				while True:
+					now = time.time()
+					if self.heap and self.heap[0][0] <= now:
+						break
+					timeout = (self.heap[0][0] - now) if self.heap else None
+					self.cond.wait(timeout)
+				func, args = heapq.heappop(self.heap)[2:]
+				self.running += 1
+			execute(func, args)
+			with self.cond:
+				self.running -= 1
+
+	def __len__(self):
+		"""
+		Returns the number of tasks waiting to be executed
+		"""
+		return len(self.heap)
+
+
 def safe(func):
 	"""
 	Executes func(*args) safely
@@ -77,35 +254,6 @@ def safe(func):
 	return wrapper
 
 
-def cache(func):
-	"""
-	Caches user/group ids for future usage
-	"""
-	def wrapper(self, uid, fields=None):
-		fields = fields or []
-		call = False
-		if uid in self.cache:
-			for field in fields:
-				if field not in self.cache[uid]:
-					call = True
-					break
-		else:
-			call = True
-		if call:
-			result = func(self, uid, fields)
-			if "id" in result:
-				del result["id"]
-			if uid in self.cache:
-				self.cache[uid].update(result)
-			else:
-				self.cache[uid] = result
-		else:
-			result = self.cache[uid]
-		return result
-	wrapper.__name__ = func.__name__
-	return wrapper
-
-
 def threaded(func):
 	"""
 	Another decorator.
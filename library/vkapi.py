@@ -11,9 +11,15 @@ Which is why it has that lot of code
 __author__ = "mrDoctorWho <mrdoctorwho@gmail.com>"
 
 import cookielib
+import errno
 import httplib
 import logging
+import metrics
+import os
+import random
 import re
+import reactor
+import select
 import socket
 import ssl
 import time
@@ -21,11 +27,48 @@ import threading
 import urllib
 import urllib2
 import webtools
+import zlib
 from printer import *
 
 SOCKET_TIMEOUT = 20
 REQUEST_RETRIES = 3
 
+# how long (in seconds) a call can take with all its retries (see attemptTo)
+REQUEST_DEADLINE = 30
+# the delay (in seconds) before the first retry, it's doubled for each next one
+RETRY_DELAY = 0.2
+RETRY_DELAY_MAX = 3
+
+# the methods are called at API_URL + method name
+# it's set from the config, so a local server can be used instead (see tools/fakevk.py)
+API_URL = "https://api.vk.com/method/"
+
+# how many idle connections are kept for a host and how long (in seconds)
+POOL_SIZE = 16
+POOL_IDLE_TIMEOUT = 60
+
+# how many requests per second are allowed for a token
+# and for the whole transport (0 means no limit), see RateLimiter
+TOKEN_RATE = 3
+GLOBAL_RATE = 0
+
+# the non-blocking requests are made by the longpoll reactor
+# these are set by library/longpoll.py: watch(opener, callback) and schedule(delay, func, args)
+watch = None
+schedule = None
+
+# how long (in seconds) the calls are collected to be sent in one execute request
+# 0 disables batching, the value is only used for the APIBinding objects created after it's set
+BATCH_WINDOW = 0
+
+# how many bytes of a response are read (and decompressed) at once
+READ_CHUNK = 65536
+
+# see CircuitBreaker
+BREAKER_ERROR_RATE = 0.5
+BREAKER_SLOW_TIME = 5
+BREAKER_OPEN_TIME = 15
+
 # VK APP ID
 APP_ID = 3789129
 # VK APP scope
@@ -42,7 +85,8 @@ ERRORS = (httplib.BadStatusLine,
 	socket.gaierror,
 	socket.timeout,
 	socket.error,
-	ssl.SSLError)
+	ssl.SSLError,
+	zlib.error)
 
 # Trying to use faster library usjon instead of simplejson
 try:
@@ -53,40 +97,167 @@ except ImportError:
 	logger.warning("vkapi: ujson wasn't loaded, using simplejson instead")
 
 
-def attemptTo(maxRetries, resultType, *errors):
+# the response bytes received and the bytes they were decompressed to
+wireBytes = metrics.counter("api/bytes/wire", "bytes")
+decodedBytes = metrics.counter("api/bytes/decoded", "bytes")
+
+
+def readBody(resp, encoding=None):
+	"""
+	Reads the response body decompressing it (gzip or deflate) by chunks as they arrive
+	Parameters:
+		resp: httplib or urllib2 response
+		encoding: the Content-Encoding header value
+	"""
+	encoding = (encoding or "").strip().lower()
+	decompressor = None
+	if encoding == "gzip":
+		decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+	elif encoding == "deflate":
+		decompressor = zlib.decompressobj()
+	chunks = []
+	wire = 0
+	while True:
+		chunk = resp.read(READ_CHUNK)
+		if not chunk:
+			break
+		if decompressor:
+			try:
+				data = decompressor.decompress(chunk)
+			except zlib.error:
+				# some servers send raw deflate data without the zlib header
+				if wire or encoding != "deflate":
+					raise
+				decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+				data = decompressor.decompress(chunk)
+			chunks.append(data)
+		else:
+			chunks.append(chunk)
+		wire += len(chunk)
+	if decompressor:
+		chunks.append(decompressor.flush())
+	body = "".join(chunks)
+	wireBytes.inc(wire)
+	decodedBytes.inc(len(body))
+	return body
+
+
+deadlines = threading.local()
+
+
+class Deadline(object):
+	"""
+	Limits the time the requests made by the current thread in the block can take
+	The nested blocks can only make the deadline closer
+	"""
+	def __init__(self, seconds):
+		self.seconds = seconds
+		self.previous = None
+
+	def __enter__(self):
+		self.previous = getattr(deadlines, "value", None)
+		deadlines.value = time.time() + self.seconds
+		if self.previous:
+			deadlines.value = min(deadlines.value, self.previous)
+		return self
+
+	def __exit__(self, *args):
+		deadlines.value = self.previous
+
+
+def getTimeLeft():
+	"""
+	Returns the time (in seconds) left until the current thread's deadline
+	"""
+	deadline = getattr(deadlines, "value", None)
+	if not deadline:
+		return float("inf")
+	return deadline - time.time()
+
+
+def getTimeout(timeout=SOCKET_TIMEOUT):
+	"""
+	Returns the socket timeout which doesn't let the request to pass the deadline
+	"""
+	return max(min(timeout, getTimeLeft()), 0.1)
+
+
+def getRetryDelay(retry):
+	"""
+	Returns the delay before the retry
+	The delay grows exponentially and a half of it is random,
+		so the calls which failed at the same moment won't be retried at the same moment
+	"""
+	delay = min(RETRY_DELAY * 2 ** (retry - 1), RETRY_DELAY_MAX)
+	return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+
+def isRetryable(exc):
+	"""
+	Tells if the call which raised the exception is worth trying again
+	"""
+	if isinstance(exc, urllib2.HTTPError):
+		return exc.code >= 500
+	return getattr(exc, "errno", None) != errno.ENETUNREACH
+
+
+def attemptTo(maxRetries, resultType, *errors, **options):
 	"""
 	Tries to execute function ignoring specified errors specified number of
 	times and returns specified result type on try limit.
+	Options:
+		deadline: how long (in seconds) all the attempts can take (REQUEST_DEADLINE by default)
+			the nested calls share the deadline and the socket timeouts are limited by it
+		retryable: function(exception) telling if the call should be retried (isRetryable by default)
+	The retries and the time spent on them are counted in api/retries/<function name>
 	"""
 	if not isinstance(resultType, type):
 		resultType = lambda result = resultType: result
 	if not errors:
 		errors = Exception
+	deadline = options.get("deadline")
+	retryable = options.get("retryable", isRetryable)
 
 	def decorator(func):
+		retried = metrics.counter("api/retries/%s" % func.func_name)
+		failed = metrics.counter("api/retries/%s/failed" % func.func_name)
+		spent = metrics.histogram("api/retries/%s/time" % func.func_name)
 
 		def wrapper(*args, **kwargs):
+			start = time.time()
 			retries = 0
-			while retries < maxRetries:
-				try:
-					data = func(*args, **kwargs)
-				except errors as exc:
-					retries += 1
-					logger.warning("vkapi: trying to execute \"%s\" in #%d time",
-						func.func_name, retries)
-					time.sleep(0.2)
-				else:
-					break
-			else:
-				if hasattr(exc, "errno") and exc.errno == 101:
-					raise NetworkNotFound()
-				data = resultType()
-				logger.warning("vkapi: Error %s occurred on executing %s(*%s, **%s)",
-					exc,
-					func.func_name,
-					str(args),
-					str(kwargs))
-			return data
+			with Deadline(deadline or REQUEST_DEADLINE):
+				while True:
+					try:
+						data = func(*args, **kwargs)
+					except CircuitOpen as exc:
+						# there's no point in trying again while the host is down
+						logger.debug("vkapi: not executing \"%s\": %s", func.func_name, exc)
+						return resultType()
+					except errors as exc:
+						retries += 1
+						delay = getRetryDelay(retries)
+						if retries >= maxRetries or not retryable(exc) or getTimeLeft() <= delay:
+							break
+						logger.warning("vkapi: trying to execute \"%s\" in #%d time",
+							func.func_name, retries)
+						retried.inc()
+						time.sleep(delay)
+					else:
+						if retries:
+							spent.observe((time.time() - start) * 1000)
+						return data
+			failed.inc()
+			if retries > 1:
+				spent.observe((time.time() - start) * 1000)
+			if getattr(exc, "errno", None) == errno.ENETUNREACH:
+				raise NetworkNotFound()
+			logger.warning("vkapi: Error %s occurred on executing %s(*%s, **%s)",
+				exc,
+				func.func_name,
+				str(args),
+				str(kwargs))
+			return resultType()
 
 		wrapper.__name__ = func.__name__
 		return wrapper
@@ -98,40 +269,917 @@ class AsyncHTTPRequest(httplib.HTTPSConnection):
 	"""
 	A method to make asynchronous http request
 	Provides a way to get a socket object to use in select()
+	The connection is made in non-blocking mode by a state machine:
+		connect -> handshake -> send -> wait
+	start() initiates it and step() should be called
+		each time the socket becomes ready for the events it returns
+	The connection is kept alive after the response is read,
+		so it can be used again for the next request to the same host
+	Plain http is used for the http:// urls (with no handshake state)
 	"""
+	# connections made and reused (tls handshakes avoided)
+	handshakes = 0
+	handshakesAvoided = 0
 
 	def __init__(self, url, data=None, headers=(), timeout=SOCKET_TIMEOUT):
-		host = urllib.splithost(urllib.splittype(url)[1])[0]
+		scheme, rest = urllib.splittype(url)
+		host = urllib.splithost(rest)[0]
 		httplib.HTTPSConnection.__init__(self, host, timeout=timeout)
+		self.secure = scheme != "http"
+		if not self.secure and ":" not in host:
+			self.port = httplib.HTTP_PORT
+		self.netloc = host
 		self.url = url
 		self.data = data
 		self.headers = headers or {}
+		self.reused = False
+		self.failed = False
+		self.attempts = 0
+		self.state = None
+		self.pending = None
+		self.deadline = 0
+
+	connected = property(lambda self: self.state == "wait")
 
-	@attemptTo(REQUEST_RETRIES, None, *ERRORS)
-	def open(self):
-		self.connect()
+	def send_request(self):
 		self.request(("POST" if self.data else "GET"), self.url, self.data,
 			self.headers)
-		return self
 
-	def read(self):
-		with self as resp:
-			return resp.read()
+	def send(self, data):
+		# while the request is being prepared, httplib's output is kept
+		# to be sent by step() when the socket is ready for writing
+		if self.pending is not None:
+			self.pending += data
+		else:
+			httplib.HTTPSConnection.send(self, data)
 
-	def __enter__(self):
-		return self.getresponse()
+	def prepare(self):
+		"""
+		Makes the request without sending it
+		"""
+		self.pending = ""
+		try:
+			self.send_request()
+		except Exception:
+			self.pending = None
+			raise
+
+	def start(self):
+		"""
+		Starts a non-blocking connection (or uses the existing one) and prepares the request
+		Only the address resolution may block here
+		Returns the events the socket should be watched for
+		"""
+		self.deadline = time.time() + self.timeout
+		self.prepare()
+		if self.sock:
+			self.sock.setblocking(0)
+			self.state = "send"
+			return reactor.WRITE
+		family, socktype, proto, name, address = socket.getaddrinfo(self.host,
+			self.port, 0, socket.SOCK_STREAM)[0]
+		sock = socket.socket(family, socktype, proto)
+		sock.setblocking(0)
+		error = sock.connect_ex(address)
+		if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+			sock.close()
+			raise socket.error(error, os.strerror(error))
+		self.sock = sock
+		self.state = "connect"
+		return reactor.WRITE
+
+	def step(self):
+		"""
+		Moves the connection to the next state if possible
+		Returns the events the socket should be watched for
+		If any error is raised the caller must unregister the socket and then call fail(),
+			so the descriptor isn't reused by another connection while it's still registered
+		"""
+		if self.state == "connect":
+			error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+			if error:
+				raise socket.error(error, os.strerror(error))
+			AsyncHTTPRequest.handshakes += 1
+			if self.secure:
+				self.sock = self._context.wrap_socket(self.sock, server_hostname=self.host,
+					do_handshake_on_connect=False)
+				self.state = "handshake"
+			else:
+				self.state = "send"
 
-	def __exit__(self, *args):
+		if self.state == "handshake":
+			try:
+				self.sock.do_handshake()
+			except ssl.SSLWantReadError:
+				return reactor.READ
+			except ssl.SSLWantWriteError:
+				return reactor.WRITE
+			self.state = "send"
+
+		if self.state == "send":
+			try:
+				sent = self.sock.send(self.pending)
+			except ssl.SSLWantReadError:
+				return reactor.READ
+			except ssl.SSLWantWriteError:
+				return reactor.WRITE
+			except socket.error as e:
+				if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+					return reactor.WRITE
+				raise
+			self.pending = self.pending[sent:]
+			if self.pending:
+				return reactor.WRITE
+			self.pending = None
+			# the response is read in blocking mode
+			self.sock.settimeout(self.timeout)
+			self.state = "wait"
+		return reactor.READ
+
+	def isStale(self):
+		"""
+		Checks if the connection can't be used anymore
+		An idle connection must not be readable: it means the server has closed it
+		"""
+		if not self.sock:
+			return True
+		try:
+			if not select.select([self.sock], [], [], 0)[0]:
+				return False
+			# tls 1.3 servers may send session tickets after the handshake
+			# which make the socket readable, but don't carry any data
+			self.sock.setblocking(0)
+			self.sock.recv(1)
+		except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+			return False
+		except socket.error as e:
+			return e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK)
+		except (select.error, ValueError):
+			pass
+		return True
+
+	def reuse(self, url, data=None):
+		"""
+		Prepares a new request over the existing connection
+		Returns None if the connection can't be used
+		"""
+		if self.isStale():
+			self.close()
+			return None
+		self.url = url
+		self.data = data
+		try:
+			self.start()
+		except (httplib.HTTPException,) + ERRORS:
+			self.close()
+			return None
+		AsyncHTTPRequest.handshakesAvoided += 1
+		self.reused = True
+		return self
+
+	def read(self):
+		"""
+		Reads the response
+		Closes the connection if the server isn't going to keep it alive
+		The attempts are counted again from the next failure
+		"""
+		try:
+			resp = self.getresponse()
+			body = readBody(resp, resp.getheader("Content-Encoding"))
+		except Exception:
+			self.fail()
+			raise
+		breakers.get(self.netloc).record(resp.status < 500)
+		self.attempts = 0
+		if resp.will_close:
+			self.close()
+		return body
+
+	def fail(self):
+		"""
+		Closes the connection which has failed
+		"""
+		breakers.get(self.netloc).record(False)
+		self.failed = True
 		self.close()
 
+	def close(self):
+		self.pending = None
+		self.state = None
+		httplib.HTTPSConnection.close(self)
+
 	@classmethod
-	def getOpener(cls, url, query={}):
+	def getOpener(cls, url, query={}, opener=None):
 		"""
-		Opens a connection to url and returns AsyncHTTPRequest() object
+		Starts a non-blocking connection to url and returns AsyncHTTPRequest() object
+		Uses the opener (if set) when it's connected to the same host
+		The number of attempts is carried over from the opener if it has failed
 		"""
 		if query:
 			url += "?%s" % urllib.urlencode(query)
-		return AsyncHTTPRequest(url).open()
+		attempts = 0
+		host = urllib.splithost(urllib.splittype(url)[1])[0]
+		try:
+			breakers.get(host).check()
+		except CircuitOpen:
+			if opener:
+				opener.close()
+			raise
+		if opener:
+			if opener.failed:
+				attempts = opener.attempts
+			elif opener.netloc == host and opener.reuse(url):
+				return opener
+			opener.close()
+		opener = AsyncHTTPRequest(url)
+		opener.attempts = attempts + 1
+		opener.start()
+		return opener
+
+
+class ConnectionPool(object):
+	"""
+	Keeps persistent (HTTP/1.1 keep-alive) connections to the API host,
+		so the calls don't have to make a tcp connection and a tls handshake each time
+	A connection is taken by one thread at a time and returned after the response is read
+	There is no limit for the connections in use, only the idle ones are limited
+	"""
+	def __init__(self, size=POOL_SIZE, idleTimeout=POOL_IDLE_TIMEOUT):
+		self.size = size
+		self.idleTimeout = idleTimeout
+		self.idle = {}
+		self.lock = threading._allocate_lock()
+		self.pid = os.getpid()
+		self.hits = metrics.counter("api/pool/hits", "connections")
+		self.misses = metrics.counter("api/pool/misses", "connections")
+		self.stale = metrics.counter("api/pool/stale", "connections")
+		metrics.gauge("api/pool/idle", self.getIdleCount, "connections")
+
+	def getIdleCount(self):
+		return sum([len(conns) for conns in self.idle.values()])
+
+	def evict(self):
+		"""
+		Closes the connections which were idle for too long
+		Must be called under the lock
+		"""
+		if os.getpid() != self.pid:
+			# the connections of the parent process must not be used after fork
+			self.idle = {}
+			self.pid = os.getpid()
+		deadline = time.time() - self.idleTimeout
+		for key, conns in self.idle.items():
+			while conns and conns[0][1] < deadline:
+				conns.pop(0)[0].close()
+			if not conns:
+				del self.idle[key]
+
+	def get(self, scheme, netloc):
+		"""
+		Returns a tuple of (connection, reused)
+		The most recently used connection is taken first
+		"""
+		with self.lock:
+			self.evict()
+			conns = self.idle.get((scheme, netloc))
+			if conns:
+				self.hits.inc()
+				return (conns.pop()[0], True)
+		self.misses.inc()
+		if scheme == "http":
+			conn = httplib.HTTPConnection(netloc, timeout=SOCKET_TIMEOUT)
+		else:
+			conn = httplib.HTTPSConnection(netloc, timeout=SOCKET_TIMEOUT)
+		return (conn, False)
+
+	def put(self, scheme, netloc, conn):
+		"""
+		Returns the connection to the pool or closes it if the pool is full
+		"""
+		with self.lock:
+			conns = self.idle.setdefault((scheme, netloc), [])
+			if len(conns) < self.size:
+				conns.append((conn, time.time()))
+				return None
+		conn.close()
+
+	def request(self, method, url, body=None, headers={}):
+		"""
+		Makes a request over a pooled connection
+		A request over a reused connection is made again over a new one
+			if the server has closed the connection while it was idle (see isStale())
+		Returns a tuple of (body, response) like RequestProcessor.post() does
+		"""
+		scheme, rest = urllib.splittype(url)
+		netloc, path = urllib.splithost(rest)
+		breaker = breakers.get(netloc)
+		breaker.check()
+		while True:
+			conn, reused = self.get(scheme, netloc)
+			conn.timeout = getTimeout()
+			if conn.sock:
+				conn.sock.settimeout(conn.timeout)
+			start = time.time()
+			sent = False
+			try:
+				conn.request(method, path or "/", body, headers)
+				sent = True
+				resp = conn.getresponse()
+				data = readBody(resp, resp.getheader("Content-Encoding"))
+			except (httplib.HTTPException, socket.error) as e:
+				conn.close()
+				if reused and self.isStale(e, sent):
+					self.stale.inc()
+					logger.debug("vkapi: pooled connection is broken (%s), making a new one", e)
+					continue
+				breaker.record(False)
+				raise
+			breaker.record(resp.status < 500, time.time() - start)
+			if resp.will_close:
+				conn.close()
+			else:
+				self.put(scheme, netloc, conn)
+			return (data, resp)
+
+	@staticmethod
+	def isStale(error, sent):
+		"""
+		Checks if the error means the connection was closed by the server before the request was made
+		Otherwise the request could have been executed (e.g. messages.send), so it's not made again
+		Parameters:
+			error: the error raised by the request
+			sent: whether the request was sent completely
+		"""
+		if isinstance(error, socket.timeout):
+			return False
+		if not sent:
+			return True
+		# the server has closed the connection without sending a byte
+		return isinstance(error, httplib.BadStatusLine) and error.line in ("", "''")
+
+
+pool = ConnectionPool()
+
+
+class CircuitBreaker(object):
+	"""
+	Stops the requests to a host which is down or too slow,
+		so the threads don't wait for the timeouts and don't pile up
+	closed: the requests are made and their results are counted for each WINDOW seconds
+		the circuit is opened if at least errorRate of them have failed or were slower than slowTime
+	open: the requests fail at once by raising CircuitOpen
+	half-open: after openTime seconds a single request is let through to probe the host
+		the circuit is closed if it succeeds and opened again (for twice as long) otherwise
+	"""
+	WINDOW = 10
+	# the circuit isn't opened if there were fewer requests in the window
+	MIN_REQUESTS = 10
+	OPEN_TIME_MAX = 300
+	# the probe is considered lost if there is no result in this time
+	PROBE_TIMEOUT = SOCKET_TIMEOUT * 2
+
+	def __init__(self, host, errorRate=BREAKER_ERROR_RATE, slowTime=BREAKER_SLOW_TIME,
+		openTime=BREAKER_OPEN_TIME):
+		self.host = host
+		self.errorRate = errorRate
+		self.slowTime = slowTime
+		self.openTime = openTime
+		self.state = "closed"
+		self.timeout = openTime
+		self.opened = 0
+		self.probed = 0
+		self.lock = threading._allocate_lock()
+		self.reset(time.time())
+
+	def reset(self, now):
+		self.start = now
+		self.requests = 0
+		self.failures = 0
+
+	def setState(self, state):
+		"""
+		Must be called under the lock
+		"""
+		logger.warning("vkapi: circuit for %s is %s (was %s)", self.host, state, self.state)
+		self.state = state
+		breakers.transitions.inc()
+
+	def trip(self, now):
+		"""
+		Opens the circuit
+		Must be called under the lock
+		"""
+		self.opened = now
+		self.setState("open")
+		breakers.trips.inc()
+
+	def allow(self):
+		"""
+		Returns True if a request can be made
+		"""
+		with self.lock:
+			now = time.time()
+			if self.state == "open":
+				if now - self.opened < self.timeout:
+					return False
+				self.setState("half-open")
+				self.probed = 0
+			if self.state == "half-open":
+				if now - self.probed < self.PROBE_TIMEOUT:
+					return False
+				self.probed = now
+		return True
+
+	def check(self):
+		"""
+		Raises CircuitOpen if a request can't be made
+		"""
+		if not self.allow():
+			breakers.rejected.inc()
+			raise CircuitOpen("%s is unavailable, the circuit is %s" % (self.host, self.state))
+
+	def record(self, success, latency=0):
+		"""
+		Counts the request result
+		Parameters:
+			success: whether the request has succeeded
+			latency: how long (in seconds) the request took
+		"""
+		failed = not success or latency >= self.slowTime
+		with self.lock:
+			now = time.time()
+			if self.state == "half-open":
+				if failed:
+					self.timeout = min(self.timeout * 2, self.OPEN_TIME_MAX)
+					self.trip(now)
+				else:
+					self.timeout = self.openTime
+					self.setState("closed")
+					self.reset(now)
+			elif self.state == "closed":
+				if now - self.start >= self.WINDOW:
+					self.reset(now)
+				self.requests += 1
+				self.failures += failed
+				if self.requests >= self.MIN_REQUESTS and self.failures >= self.requests * self.errorRate:
+					self.trip(now)
+
+	def getDelay(self):
+		"""
+		Returns the time (in seconds) left until the circuit is half-open
+		"""
+		if self.state != "open":
+			return 0
+		return max(self.opened + self.timeout - time.time(), 0)
+
+
+class CircuitBreakers(object):
+	"""
+	Keeps a circuit breaker for each host
+	"""
+	def __init__(self):
+		self.breakers = {}
+		self.lock = threading._allocate_lock()
+		self.trips = metrics.counter("api/breaker/trips", "times")
+		self.transitions = metrics.counter("api/breaker/transitions", "times")
+		self.rejected = metrics.counter("api/breaker/rejected", "requests")
+		metrics.gauge("api/breaker/open", self.getOpenCount, "hosts")
+
+	def get(self, host):
+		with self.lock:
+			breaker = self.breakers.get(host)
+			if not breaker:
+				breaker = self.breakers[host] = CircuitBreaker(host)
+		return breaker
+
+	def getOpenCount(self):
+		return len([breaker for breaker in self.breakers.values() if breaker.state != "closed"])
+
+	def getDelay(self, url):
+		"""
+		Returns the time (in seconds) left until the requests to the url's host can be made again
+		"""
+		if "://" in url:
+			url = urllib.splithost(urllib.splittype(url)[1])[0]
+		return self.get(url).getDelay()
+
+
+breakers = CircuitBreakers()
+
+
+class TokenBucket(object):
+	"""
+	Allows rate requests per second with bursts up to capacity
+	Each request takes a token, the tokens are added back with time
+	The rate is halved when VK complains about the requests being too fast
+		and it grows back to the normal value after RECOVERY_PERIOD seconds of quiet
+	"""
+	RECOVERY_PERIOD = 30
+	MIN_RATE = 0.2
+
+	def __init__(self, rate, capacity=None):
+		self.baseRate = self.rate = float(rate)
+		self.capacity = capacity or max(rate, 1)
+		self.tokens = self.capacity
+		self.updated = time.time()
+		self.penalized = 0
+		self.lock = threading._allocate_lock()
+
+	def refill(self, now):
+		"""
+		Must be called under the lock
+		"""
+		if self.rate < self.baseRate and (now - self.penalized) >= self.RECOVERY_PERIOD:
+			self.rate = min(self.rate * 2, self.baseRate)
+			self.penalized = now
+		self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.capacity)
+		self.updated = now
+
+	def reserve(self):
+		"""
+		Takes a token (it may be taken in advance)
+		Returns the time (in seconds) to wait before making the request
+		"""
+		with self.lock:
+			self.refill(time.time())
+			self.tokens -= 1
+			if self.tokens >= 0:
+				return 0
+			return -self.tokens / self.rate
+
+	def isAvailable(self):
+		with self.lock:
+			self.refill(time.time())
+			return self.tokens >= 1
+
+	def penalize(self):
+		with self.lock:
+			now = time.time()
+			# the requests which were made at once may all fail, but it's a single burst
+			if (now - self.penalized) < 1:
+				return None
+			self.refill(now)
+			self.rate = max(self.rate / 2, self.MIN_RATE)
+			self.penalized = now
+
+	def isIdle(self, now):
+		with self.lock:
+			return self.tokens >= 0 and (now - self.updated) > self.RECOVERY_PERIOD * 10
+
+
+class RateLimiter(object):
+	"""
+	Limits the requests per access token and (optionally) all the requests made by the transport
+	The buckets are shared by all APIBinding objects using the same token
+	"""
+	# how often (in seconds) the unused buckets are removed
+	CLEANUP_INTERVAL = 600
+
+	def __init__(self, tokenRate=TOKEN_RATE, globalRate=GLOBAL_RATE):
+		self.buckets = {}
+		self.lock = threading._allocate_lock()
+		self.lastCleanup = time.time()
+		self.configure(tokenRate, globalRate)
+		self.waits = metrics.histogram("api/limiter/wait")
+		self.rejected = metrics.counter("api/limiter/rejected", "requests")
+		self.penalties = metrics.counter("api/limiter/penalties", "times")
+		metrics.gauge("api/limiter/buckets", lambda: len(self.buckets), "tokens")
+
+	def configure(self, tokenRate, globalRate):
+		self.tokenRate = tokenRate
+		self.globalBucket = TokenBucket(globalRate) if globalRate else None
+
+	def getBuckets(self, token):
+		buckets = [self.globalBucket] if self.globalBucket else []
+		if token:
+			with self.lock:
+				now = time.time()
+				if (now - self.lastCleanup) > self.CLEANUP_INTERVAL:
+					self.lastCleanup = now
+					for key, bucket in self.buckets.items():
+						if bucket.isIdle(now):
+							del self.buckets[key]
+				if token not in self.buckets:
+					self.buckets[token] = TokenBucket(self.tokenRate)
+				buckets.append(self.buckets[token])
+		return buckets
+
+	def reserve(self, token):
+		"""
+		Reserves a request for the token
+		Returns the time (in seconds) to wait before making it
+		"""
+		wait = 0
+		for bucket in self.getBuckets(token):
+			wait = max(wait, bucket.reserve())
+		self.waits.observe(wait * 1000)
+		return wait
+
+	def acquire(self, token):
+		"""
+		Waits until a request can be made for the token
+		"""
+		wait = self.reserve(token)
+		if wait:
+			time.sleep(wait)
+
+	def isAvailable(self, token):
+		"""
+		Checks if a request can be made for the token without waiting
+		"""
+		for bucket in self.getBuckets(token):
+			if not bucket.isAvailable():
+				self.rejected.inc()
+				return False
+		return True
+
+	def penalize(self, token):
+		"""
+		Slows the requests down after VK has returned "too many requests" or "flood control"
+		"""
+		self.penalties.inc()
+		for bucket in self.getBuckets(token):
+			bucket.penalize()
+
+
+limiter = RateLimiter()
+
+
+class MethodMetrics(object):
+	"""
+	Keeps the metrics of a VK method (api/methods/<method>/...)
+	The objects are created once for each method, so counting a call is cheap
+	"""
+	methods = {}
+	lock = threading._allocate_lock()
+
+	def __init__(self, method):
+		self.prefix = "api/methods/%s" % method
+		self.calls = metrics.counter(self.prefix + "/calls", "calls")
+		self.latency = metrics.histogram(self.prefix + "/latency")
+		self.retries = metrics.counter(self.prefix + "/retries", "calls")
+		self.sent = metrics.counter(self.prefix + "/bytes/out", "bytes")
+		self.received = metrics.counter(self.prefix + "/bytes/in", "bytes")
+		self.errors = {}
+
+	@classmethod
+	def get(cls, method):
+		metric = cls.methods.get(method)
+		if not metric:
+			with cls.lock:
+				metric = cls.methods.setdefault(method, cls(method))
+		return metric
+
+	def observe(self, start, sent=0, received=0):
+		"""
+		Counts the finished call
+		Parameters:
+			start: the time the call was started at
+			sent, received: the request and the response sizes
+		"""
+		self.calls.inc()
+		self.latency.observe((time.time() - start) * 1000)
+		if sent:
+			self.sent.inc(sent)
+		if received:
+			self.received.inc(received)
+
+	def error(self, code):
+		"""
+		Counts the error by its VK code ("network" if no response was received)
+		"""
+		counter = self.errors.get(code)
+		if not counter:
+			counter = self.errors[code] = metrics.counter("%s/errors/%s" % (self.prefix, code))
+		counter.inc()
+
+
+class Future(object):
+	"""
+	The result of a non-blocking call
+	The callback (if set) is executed with the future as soon as the result is set
+	"""
+	def __init__(self, callback=None):
+		self.event = threading.Event()
+		self.callbacks = [callback] if callback else []
+		self.lock = threading._allocate_lock()
+		self.value = None
+		self.exception = None
+		self.start = time.time()
+
+	def done(self):
+		return self.event.isSet()
+
+	def result(self, timeout=None):
+		"""
+		Waits for the result and returns it
+		Raises the exception the call has failed with
+		"""
+		if not self.event.wait(timeout):
+			raise socket.timeout("The result wasn't received in time")
+		if self.exception:
+			raise self.exception
+		return self.value
+
+	def addCallback(self, callback):
+		with self.lock:
+			if not self.done():
+				self.callbacks.append(callback)
+				return None
+		callback(self)
+
+	def setResult(self, value):
+		self.value = value
+		self.finish()
+
+	def setException(self, exception):
+		self.exception = exception
+		self.finish()
+
+	def finish(self):
+		with self.lock:
+			self.event.set()
+			callbacks, self.callbacks = self.callbacks, []
+		for callback in callbacks:
+			try:
+				callback(self)
+			except Exception:
+				logger.exception("vkapi: future callback has failed")
+
+
+class AsyncConnections(object):
+	"""
+	Keeps the idle connections used by the non-blocking calls
+	"""
+	def __init__(self, size=POOL_SIZE):
+		self.size = size
+		self.idle = {}
+		self.lock = threading._allocate_lock()
+
+	def get(self, url, data, headers):
+		"""
+		Returns a started request over an idle connection or a new one
+		"""
+		host = urllib.splithost(urllib.splittype(url)[1])[0]
+		breakers.get(host).check()
+		while True:
+			with self.lock:
+				openers = self.idle.get(host)
+				opener = openers.pop() if openers else None
+			if not opener:
+				break
+			if opener.reuse(url, data):
+				return opener
+		opener = AsyncHTTPRequest(url, data, headers)
+		opener.attempts = 1
+		opener.start()
+		return opener
+
+	def put(self, opener):
+		if opener.sock:
+			with self.lock:
+				openers = self.idle.setdefault(opener.netloc, [])
+				if len(openers) < self.size:
+					openers.append(opener)
+					return None
+			opener.close()
+
+
+asyncConnections = AsyncConnections()
+
+
+class BatchedCall(object):
+	"""
+	A method call waiting to be sent in a batch
+	"""
+	def __init__(self, method, values):
+		self.method = method
+		self.values = values
+		# the call has been taken by a leader to be sent
+		self.taken = False
+		self.done = False
+		self.result = None
+		# a VK error dict (handled by the caller's thread)
+		self.error = None
+		# any other exception
+		self.exception = None
+		# the call should be made again without batching
+		self.alone = False
+		self.start = time.time()
+
+
+class Batcher(object):
+	"""
+	Collects the calls made by the threads using the same token
+		and sends them as one execute request (up to 25 calls in it)
+	The thread whose call is the first in the queue is the leader:
+		it waits for the window to pass (or the batch to be full) and sends the batch
+	Each thread gets its own result or error
+	"""
+	MAX_CALLS = 25
+	# these are never batched
+	EXCLUDE = ("execute", "messages.getLongPollServer")
+	# the calls which got these errors inside execute are made again by themselves
+	# (flood control and captcha must be handled as if the method was called directly)
+	RETRY_ALONE = (6, 9, 14)
+	calls = metrics.counter("api/batch/calls", "calls")
+	requests = metrics.counter("api/batch/requests", "requests")
+	sizes = metrics.histogram("api/batch/size", "calls", range(1, 26))
+
+	def __init__(self, engine, window):
+		self.engine = engine
+		self.window = window
+		self.queue = []
+		self.cond = threading.Condition(threading.Lock())
+
+	def call(self, method, values):
+		if method in self.EXCLUDE or method.startswith("execute."):
+			return self.engine.call(method, values)
+		call = BatchedCall(method, values)
+		batch = None
+		with self.cond:
+			self.queue.append(call)
+			if len(self.queue) >= self.MAX_CALLS:
+				self.cond.notify_all()
+			while not call.taken and self.queue[0] is not call:
+				self.cond.wait()
+			if not call.taken:
+				deadline = time.time() + self.window
+				while len(self.queue) < self.MAX_CALLS and time.time() < deadline:
+					self.cond.wait(deadline - time.time())
+				batch = self.queue[:self.MAX_CALLS]
+				del self.queue[:self.MAX_CALLS]
+				for entry in batch:
+					entry.taken = True
+				# the next call in the queue becomes the leader
+				self.cond.notify_all()
+		if batch:
+			try:
+				self.send(batch)
+			except Exception as e:
+				for entry in batch:
+					entry.exception = e
+			with self.cond:
+				for entry in batch:
+					entry.done = True
+				self.cond.notify_all()
+		with self.cond:
+			while not call.done:
+				self.cond.wait()
+		if call.exception:
+			raise call.exception
+		if call.alone:
+			metric = MethodMetrics.get(call.method)
+			metric.error(call.error.get("error_code"))
+			metric.retries.inc()
+			return self.engine.call(call.method, call.values)
+		if call.error:
+			# the errors handlers look at the method which has failed
+			self.engine.lastMethod = (call.method, call.values)
+			return self.engine.handleError(call.method, call.values, call.error)
+		return call.result
+
+	def getCode(self, batch):
+		"""
+		Makes the VKScript code
+		"""
+		calls = []
+		for entry in batch:
+			calls.append("API.%s(%s)" % (entry.method, json.dumps(entry.values)))
+		return "return [%s];" % ",".join(calls)
+
+	def send(self, batch):
+		"""
+		Sends the batch and sets the results
+		The calls which have failed have false as their result
+			and their errors are listed in execute_errors in the same order
+		"""
+		self.calls.inc(len(batch))
+		self.sizes.observe(len(batch))
+		if len(batch) == 1:
+			entry = batch[0]
+			entry.result = self.engine.call(entry.method, entry.values)
+			return None
+		self.requests.inc()
+		body = self.engine.fetch("execute", {"code": self.getCode(batch)})
+		if body is None:
+			return None
+		if "error" in body:
+			# the whole request has failed, so each call gets the error
+			for entry in batch:
+				entry.error = body["error"]
+			return None
+		results = body.get("response") or []
+		errors = list(body.get("execute_errors", ()))
+		for num, entry in enumerate(batch):
+			MethodMetrics.get(entry.method).observe(entry.start)
+			result = results[num] if num < len(results) else False
+			if result is False:
+				entry.error = errors.pop(0) if errors else {"error_code": 1,
+					"error_msg": "Unknown error in execute"}
+				entry.alone = entry.error.get("error_code") in self.RETRY_ALONE
+			else:
+				entry.result = result or {}
 
 
 class RequestProcessor(object):
@@ -142,7 +1190,8 @@ class RequestProcessor(object):
 	"""
 	headers = {"User-agent": "Mozilla/5.0 (X11; Ubuntu; Linux i686; rv:21.0)"
 					" Gecko/20130309 Firefox/21.0",
-				"Accept-Language": "ru-RU, utf-8"}
+				"Accept-Language": "ru-RU, utf-8",
+				"Accept-Encoding": "gzip, deflate"}
 	boundary = "github.com/mrDoctorWho/vk4xmpp"
 
 	def __init__(self, cook=False):
@@ -194,8 +1243,17 @@ class RequestProcessor(object):
 		"""
 		POST request
 		"""
-		resp = self.open(self.request(url, data, urlencode=urlencode))
-		body = resp.read()
+		breaker = breakers.get(urllib.splithost(urllib.splittype(url)[1])[0])
+		breaker.check()
+		start = time.time()
+		try:
+			resp = self.open(self.request(url, data, urlencode=urlencode), timeout=getTimeout())
+			body = readBody(resp, resp.info().getheader("Content-Encoding"))
+		except ERRORS as e:
+			# the client errors (4xx) don't mean the host is down
+			breaker.record(getattr(e, "code", 500) < 500)
+			raise
+		breaker.record(True, time.time() - start)
 		return (body, resp)
 
 	def get(self, url, query={}):
@@ -205,7 +1263,7 @@ class RequestProcessor(object):
 		if query:
 			url += "?%s" % urllib.urlencode(query)
 		resp = self.open(self.request(url))
-		body = resp.read()
+		body = readBody(resp, resp.info().getheader("Content-Encoding"))
 		return (body, resp)
 
 
@@ -290,23 +1348,47 @@ class APIBinding(RequestProcessor):
 	def __init__(self, token, debug=[], logline=""):
 		self.token = token
 		self.debug = debug
-		self.last = []
 		self.captcha = {}
 		self.lastMethod = ()
-		self.timeout = 1.00
+		self.batcher = Batcher(self, BATCH_WINDOW) if BATCH_WINDOW else None
 		# to use it in logs without showing the token
 		self.logline = logline
 		RequestProcessor.__init__(self)
 
-	def method(self, method, values=None, notoken=False):
+	def method(self, method, values=None, notoken=False, block=True):
 		"""
 		Issues a VK method
+		The call is made as a part of an execute request if batching is enabled (see Batcher)
 		Parameters:
 			method: vk method
 			values: method parameters
+			block: wait if the request rate is exceeded (raises RateLimited otherwise)
 		"""
-		url = "https://api.vk.com/method/%s" % method
 		values = values or {}
+		if not block and not limiter.isAvailable(None if notoken else self.token):
+			raise RateLimited()
+		if self.batcher and not notoken and "key" not in self.captcha:
+			return self.batcher.call(method, values)
+		return self.call(method, values, notoken)
+
+	def call(self, method, values, notoken=False):
+		"""
+		Makes the request for the method
+		Returns the method result, errors are handled by handleError()
+		"""
+		body = self.fetch(method, values, notoken)
+		if body is None:
+			return None
+		if "response" in body:
+			return body["response"] or {}
+		# according to vk.com/dev/errors
+		elif "error" in body:
+			return self.handleError(method, values, body["error"])
+
+	def prepare(self, method, values, notoken=False):
+		"""
+		Adds the token, the API version and the captcha (if it's entered) to the values
+		"""
 		if not notoken:
 			values["access_token"] = self.token
 		values["v"] = "5.42"
@@ -317,79 +1399,179 @@ class APIBinding(RequestProcessor):
 			self.captcha = {}
 
 		self.lastMethod = (method, values)
+
+	def methodAsync(self, method, values=None, notoken=False, callback=None):
+		"""
+		Non-blocking variant of method()
+		The request is made by the longpoll reactor, so no thread waits for it
+		Returns a Future, the callback (if set) is executed with it when the result is ready
+		The errors are translated the same way method() does, the exceptions are set in the future
+		"""
+		future = Future(callback)
+		values = values or {}
+		self.prepare(method, values, notoken)
+		wait = limiter.reserve(None if notoken else self.token)
+		if wait:
+			schedule(wait, self.sendAsync, (method, values, future))
+		else:
+			self.sendAsync(method, values, future)
+		return future
+
+	def sendAsync(self, method, values, future, retry=True):
+		headers = dict(self.headers)
+		headers["Content-Type"] = "application/x-www-form-urlencoded; charset=UTF-8"
+		data = urllib.urlencode(values)
+		MethodMetrics.get(method).sent.inc(len(data))
+		try:
+			opener = asyncConnections.get(API_URL + method, data, headers)
+		except (httplib.HTTPException,) + ERRORS as e:
+			MethodMetrics.get(method).error("network")
+			return future.setException(e)
+		watch(opener, lambda opener, error: self.finishAsync(method, values, future,
+			opener, error, retry))
+
+	def finishAsync(self, method, values, future, opener, error, retry):
+		"""
+		Reads the response and sets the result (executed by the longpoll workers)
+		"""
+		body = None
+		if not error:
+			try:
+				body = opener.read()
+			except (httplib.HTTPException,) + ERRORS as e:
+				error = e
+		metric = MethodMetrics.get(method)
+		if error:
+			opener.close()
+			# the server may have closed the idle connection
+			if opener.reused and retry:
+				return self.sendAsync(method, values, future, False)
+			metric.error("network")
+			return future.setException(error)
+		asyncConnections.put(opener)
+		metric.observe(future.start, received=len(body or ""))
+		try:
+			body = json.loads(body) if body else {}
+		except ValueError:
+			body = {"response": {}}
+
+		if "response" in body:
+			return future.setResult(body["response"] or {})
+		elif "error" not in body:
+			return future.setResult(None)
+		if body["error"].get("error_code") in (6, 9):
+			logger.warning("vkapi: got code %s, slowing the requests down (for: %s)",
+				body["error"]["error_code"], self.logline)
+			limiter.penalize(self.token)
+			metric.error(body["error"]["error_code"])
+			metric.retries.inc()
+			return self.methodAsync(method, values, callback=lambda result: self.copyResult(result, future))
+		try:
+			future.setResult(self.handleError(method, values, body["error"]))
+		except Exception as e:
+			future.setException(e)
+
+	@staticmethod
+	def copyResult(source, future):
+		if source.exception:
+			future.setException(source.exception)
+		else:
+			future.setResult(source.value)
+
+	def fetch(self, method, values, notoken=False):
+		"""
+		Sends the method and returns the decoded response body
+		Returns None if no response was received
+		"""
+		url = API_URL + method
+		self.prepare(method, values, notoken)
 		# prevent “too fast” errors
-		self.last.append(time.time())
-		if len(self.last) > 2:
-			if (self.last.pop() - self.last.pop(0)) <= self.timeout:
-				time.sleep(self.timeout / 3.0)
+		limiter.acquire(None if notoken else self.token)
 
 		start = time.time()
 		if method in self.debug or self.debug == "all":
 			Print("SENT: method %s with values %s in thread: %s" % (method,
 				colorizeJSON(str(values)), threading.currentThread().name))
 
-		response = self.post(url, values)
-		if response:
-			body, response = response
-			if body:
-				try:
-					body = json.loads(body)
-				except ValueError:
-					return {}
-
-			if self.debug:
-				end = time.time()
-				dbg = (method, colorizeJSON(str(body)), threading.currentThread().name, (end - start), self.logline)
-				if method in self.debug or self.debug == "all":
-					Print("GOT: for method %s: %s in thread: %s (%0.2fs) for %s" % dbg)
-
-				if self.debug == "slow":
-					if (end - start) > 3:
-						Print("GOT: (slow) response for method %s: %s in thread: %s (%0.2fs) for %s" % dbg)
-
-			if "response" in body:
-				return body["response"] or {}
-
-			# according to vk.com/dev/errors
-			elif "error" in body:
-				error = body["error"]
-				eCode = error["error_code"]
-				eMsg = error.get("error_msg", "")
-				logger.error("vkapi: error occured on executing method"
-					" (%s(%s), code: %s, msg: %s), (for: %s)" % (method, values, eCode, eMsg, self.logline))
-
-				if eCode == 7:  # not allowed
-					raise NotAllowed(eMsg)
-
-				elif eCode == 10:  # internal server error
-					raise InternalServerError(eMsg)
-
-				elif eCode == 13:  # runtime error
-					raise RuntimeError(eMsg)
-
-				elif eCode == 14:  # captcha
-					if "captcha_sid" in error:
-						self.captcha = {"sid": error["captcha_sid"], "img": error["captcha_img"]}
-						raise CaptchaNeeded()
-
-				elif eCode == 15:
-					raise AccessDenied(eMsg)
-
-				elif eCode == 17:
-					raise ValidationRequired(eMsg)
-
-				# 1 - unknown error / 100 - wrong method or parameters loss
-				elif eCode in (1, 6, 9, 100):
-					if eCode in (6, 9):   # 6 - too fast / 9 - flood control
-						self.timeout += 0.05
-						# logger doesn't seem to support %0.2f
-						logger.warning("vkapi: got code %s, increasing timeout to %0.2f (for: %s)" %
-							(eCode, self.timeout, self.logline))
-						# waiting a bit and trying to execute te method again
-						time.sleep(self.timeout)
-						return self.method(method, values)
-					return {"error": eCode}
-				raise VkApiError(eMsg)
+		metric = MethodMetrics.get(method)
+		data = urllib.urlencode(values)
+		response = self.postMethod(url, data)
+		if not response:
+			metric.error("network")
+			return None
+		body, response = response
+		metric.observe(start, len(data), len(body))
+		try:
+			body = json.loads(body) if body else {}
+		except ValueError:
+			return {"response": {}}
+
+		if self.debug:
+			end = time.time()
+			dbg = (method, colorizeJSON(str(body)), threading.currentThread().name, (end - start), self.logline)
+			if method in self.debug or self.debug == "all":
+				Print("GOT: for method %s: %s in thread: %s (%0.2fs) for %s" % dbg)
+
+			if self.debug == "slow":
+				if (end - start) > 3:
+					Print("GOT: (slow) response for method %s: %s in thread: %s (%0.2fs) for %s" % dbg)
+		return body
+
+	def handleError(self, method, values, error):
+		"""
+		Translates a VK error to an exception
+		Some errors are returned as {"error": code} and some make the method to be called again
+		"""
+		eCode = error["error_code"]
+		eMsg = error.get("error_msg", "")
+		metric = MethodMetrics.get(method)
+		metric.error(eCode)
+		logger.error("vkapi: error occured on executing method"
+			" (%s(%s), code: %s, msg: %s), (for: %s)" % (method, values, eCode, eMsg, self.logline))
+
+		if eCode == 7:  # not allowed
+			raise NotAllowed(eMsg)
+
+		elif eCode == 10:  # internal server error
+			raise InternalServerError(eMsg)
+
+		elif eCode == 13:  # runtime error
+			raise RuntimeError(eMsg)
+
+		elif eCode == 14:  # captcha
+			if "captcha_sid" in error:
+				self.captcha = {"sid": error["captcha_sid"], "img": error["captcha_img"]}
+				raise CaptchaNeeded()
+
+		elif eCode == 15:
+			raise AccessDenied(eMsg)
+
+		elif eCode == 17:
+			raise ValidationRequired(eMsg)
+
+		# 1 - unknown error / 100 - wrong method or parameters loss
+		# 907, 908 - the longpoll ts/pts is too old or too new to get the history
+		elif eCode in (1, 6, 9, 100, 907, 908):
+			if eCode in (6, 9):   # 6 - too fast / 9 - flood control
+				logger.warning("vkapi: got code %s, slowing the requests down (for: %s)",
+					eCode, self.logline)
+				limiter.penalize(self.token)
+				metric.retries.inc()
+				# the limiter makes us wait a bit before trying to execute the method again
+				return self.method(method, values)
+			return {"error": eCode}
+		raise VkApiError(eMsg)
+
+	@attemptTo(REQUEST_RETRIES, tuple, *ERRORS)
+	def postMethod(self, url, data):
+		"""
+		POST request over a pooled keep-alive connection
+		Parameters:
+			data: urlencoded method parameters
+		"""
+		headers = dict(self.headers)
+		headers["Content-Type"] = "application/x-www-form-urlencoded; charset=UTF-8"
+		return pool.request("POST", url, data, headers)
 
 	def retry(self):
 		"""
@@ -415,6 +1597,22 @@ class NetworkNotFound(Exception):
 	pass
 
 
+class CircuitOpen(socket.error):
+	"""
+	Raised when a host is considered unavailable (see CircuitBreaker)
+	It's a socket error, so it's handled as any other network error
+	"""
+	pass
+
+
+class RateLimited(Exception):
+	"""
+	Raised when a method can't be called without waiting
+	(see APIBinding.method() block parameter)
+	"""
+	pass
+
+
 class LongPollError(Exception):
 	"""
 	Should be raised when longpoll exception occurred
@@ -56,7 +56,7 @@ def incoming_message_handler(cl, msg):
 				if send:
 					with user.sync:
 						user.vk.sendMessage(body, id, "chat_id")
-					runDatabaseQuery("update groupchats set last_used=? where jid=?", (time.time(), source), set=True)
+					bufferDatabaseQuery("update groupchats set last_used=? where jid=?", (time.time(), source), source)
 					raise xmpp.NodeProcessed()
 
 
@@ -72,11 +72,12 @@ def handleChatPresences(source, prs):
 
 				if (prs.getRole(), prs.getAffiliation()) == ("moderator", "owner"):
 					if jid != TransportID:
-						runDatabaseQuery("update groupchats set owner=? where jid=?", (source, jid), set=True)
+						runDatabaseQuery("update groupchats set owner=? where jid=?", (source, jid), set=True, wait=False)
 
 			if jid.split("/")[0] == user.source:
 				chat.owner_nickname = prs.getFrom().getResource()
-				runDatabaseQuery("update groupchats set nick=? where jid=? ", (chat.owner_nickname, source), set=True)
+				runDatabaseQuery("update groupchats set nick=? where jid=? ", (chat.owner_nickname, source),
+					set=True, wait=False)
 			raise xmpp.NodeProcessed()
 
 		elif user and prs.getType() != "unavailable":
@@ -8,11 +8,14 @@ from __main__ import *
 from __main__ import _
 from utils import buildDataForm as buildForm, buildIQError
 from xmpp import DataForm as getForm
+import metrics
 import modulemanager
+import registry
 
 NODES = {"admin": ("Delete users",
 					"Global message",
 					"Show crash logs",
+					"Show metrics",
 					"Reload config",
 					"Global Transport settings",
 					"Check an API token",
@@ -52,7 +55,6 @@ def disco_handler(cl, iq):
 				users = Transport.keys()
 			elif node == "All users":
 				users = getUsersList()
-				users = [user[0] for user in users]
 
 			for user in users:
 				payload.append(xmpp.Node("item", {"name": user, "jid": user}))
@@ -78,7 +80,7 @@ def disco_handler(cl, iq):
 	sender(cl, result)
 
 
-getUsersList = lambda: runDatabaseQuery("select jid from users", many=True)
+getUsersList = lambda: registry.users.getJids()
 deleteUsers = lambda jids: [utils.execute(removeUser, (key,), False) for key in jids]
 
 
@@ -118,6 +120,14 @@ def checkAPIToken(token):
 	return data
 
 
+def dumpMetrics(prefix):
+	"""
+	Returns the metrics whose names start with the prefix as text (see library/metrics.py)
+	"""
+	lines = ["%s: %s %s" % (name, value, units) for name, value, units in metrics.read(prefix)]
+	return str.join("\n", lines) or "No metrics found."
+
+
 def dictToDataForm(_dict, _fields=None):
 	"""
 	Makes a buildForm()-compatible dict from a random key-value dict
@@ -214,6 +224,18 @@ def commands_handler(cl, iq):
 								fields=[{"var": "body", "type": "text-multi", "label": "Error body", "value": body}])
 							completed = True
 
+				elif node == "Show metrics":
+					if not form:
+						simpleForm = buildForm(simpleForm,
+							fields=[{"var": "prefix", "type": "text-single", "label": "Metrics prefix",
+								"value": "api/methods/"}],
+							title="Metrics to show (empty for all)")
+					else:
+						body = dumpMetrics(dictForm.get("prefix") or "")
+						simpleForm = buildForm(simpleForm,
+							fields=[{"var": "body", "type": "text-multi", "label": "Metrics", "value": body}])
+						completed = True
+
 				elif node == "Check an API token":
 					if not form:
 						simpleForm = buildForm(simpleForm,
@@ -3,6 +3,7 @@
 # © simpleApps, 2013 — 2015.
 
 from __main__ import *
+import metrics
 
 
 STAT_FIELDS = {
@@ -29,6 +30,9 @@ def stats_handler(cl, iq):
 			for key in keys:
 				node = xmpp.Node("stat", {"name": key})
 				queryPayload.append(node)
+			# the metrics are listed after the default fields (see library/metrics.py)
+			for name, value, units in metrics.read():
+				queryPayload.append(xmpp.Node("stat", {"name": name}))
 		else:
 			users = calcStats()
 			try:
@@ -45,6 +49,7 @@ def stats_handler(cl, iq):
 					"seconds": [time],
 					"threads": [threading.activeCount()],
 					"messages": [Stats["msgout"], Stats["msgin"]]}
+			values = dict((name, (value, units)) for name, value, units in metrics.read())
 			for child in iqChildren:
 				if child.getName() == "stat":
 					name = child.getAttr("name")
@@ -55,6 +60,12 @@ def stats_handler(cl, iq):
 						node.setAttr("name", name)
 						node.setAttr("value", value)
 						queryPayload.append(node)
+					elif name in values:
+						value, units = values[name]
+						node = xmpp.Node("stat", {"units": units})
+						node.setAttr("name", name)
+						node.setAttr("value", value)
+						queryPayload.append(node)
 		if queryPayload:
 			result.setQueryPayload(queryPayload)
 			sender(cl, result)
@@ -52,8 +52,13 @@ def vcard_handler(cl, iq):
 				id = vk2xmpp(destination)
 				args = ["screen_name"]
 				values = VCARD_FIELDS.copy()
-				if id in user.friends.keys():
+				if id in user.friends:
 					args.append(PhotoSize)
+					# clients usually ask for all the friends' vcards at once
+					# so their data is got by one request (again after it has expired) and the rest are taken from the cache
+					if (time.time() - user.vcardsPrefetched) > PROFILE_CACHE_TTL:
+						user.vk.getUsersData(user.friends.keys(), args)
+						user.vcardsPrefetched = time.time()
 				data = user.vk.getUserData(id, args)
 				name = data.get("name", str(data))
 				screen_name = data.get("screen_name")
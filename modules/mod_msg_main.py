@@ -61,8 +61,8 @@ def message_handler(cl, msg):
 		if msg.getTag("composing"):
 			target = vk2xmpp(destination)
 			if target != TransportID:
-				with user.sync:
-					user.vk.method("messages.setActivity", {"user_id": target, "type": "typing"}, True)
+				# nobody waits for the result, so it's made without blocking
+				user.vk.methodAsync("messages.setActivity", {"user_id": target, "type": "typing"}, force=True)
 		if body:
 			answer = None
 			if jidTo == TransportID:
@@ -0,0 +1,42 @@
+# coding: utf-8
+# This file is a part of VK4XMPP transport
+# © simpleApps, 2015.
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "library"))
+
+import profiles
+
+
+class ProfileCacheTest(unittest.TestCase):
+
+	def setUp(self):
+		self.cache = profiles.ProfileCache()
+		self.calls = []
+
+	def fetch(self, ids, fields):
+		self.calls.append(list(ids))
+		return [{"id": int(id), "first_name": "User", "last_name": str(id), "name": "User %s" % id}
+			for id in ids]
+
+	def testStringId(self):
+		# VK.getUserData() is called with the ids taken from jids
+		data = self.cache.get("user", "1", [], self.fetch, {})
+		self.assertEqual(data["name"], "User 1")
+		self.assertEqual(self.cache.get("user", 1, [], self.fetch, {})["name"], "User 1")
+		self.assertEqual(len(self.calls), 1)
+
+	def testKeysArePreserved(self):
+		result = self.cache.getMany("user", ["2", 3], [], self.fetch, {})
+		self.assertEqual(sorted(result.keys()), [3, "2"])
+
+	def testBadId(self):
+		self.assertEqual(self.cache.get("user", "nobody", [], self.fetch, {}), {})
+		self.assertEqual(self.calls, [])
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,71 @@
+# coding: utf-8
+# This file is a part of VK4XMPP transport
+# © simpleApps, 2015.
+
+import os
+import select
+import socket
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "library"))
+sys.path.insert(0, os.path.join(ROOT, "tools"))
+
+import fakevk
+import reactor
+import vkapi as api
+
+
+def getFreePort():
+	sock = socket.socket()
+	sock.bind(("127.0.0.1", 0))
+	port = sock.getsockname()[1]
+	sock.close()
+	return port
+
+
+def complete(opener):
+	"""
+	Makes the request in the same way the reactor does and reads the response
+	"""
+	events = reactor.WRITE
+	while not opener.connected:
+		if events == reactor.WRITE:
+			select.select([], [opener.sock], [], 5)
+		else:
+			select.select([opener.sock], [], [], 5)
+		events = opener.step()
+	return opener.read()
+
+
+class OpenerAttemptsTest(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		cls.port = getFreePort()
+		cls.server = fakevk.start(port=cls.port)
+		cls.url = "http://127.0.0.1:%d/method/users.get" % cls.port
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.server.shutdown()
+
+	def testFailSucceedFail(self):
+		opener = api.AsyncHTTPRequest.getOpener(self.url)
+		self.assertEqual(opener.attempts, 1)
+		opener.fail()
+		opener = api.AsyncHTTPRequest.getOpener(self.url, opener=opener)
+		# the attempts are carried over from the failed opener
+		self.assertEqual(opener.attempts, 2)
+		self.assertTrue(complete(opener))
+		# and counted again after the response is read
+		self.assertEqual(opener.attempts, 0)
+		opener.fail()
+		opener = api.AsyncHTTPRequest.getOpener(self.url, opener=opener)
+		self.assertEqual(opener.attempts, 1)
+		opener.close()
+
+
+if __name__ == "__main__":
+	unittest.main()
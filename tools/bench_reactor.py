@@ -0,0 +1,111 @@
+#!/usr/bin/env python2
+# coding: utf-8
+# This file is a part of VK4XMPP transport
+# © simpleApps, 2015.
+
+"""
+Measures the cost of a single longpoll wakeup for the reactor backends
+A number of idle UDP sockets is registered and a few of them are made ready
+Usage: tools/bench_reactor.py [-n 500,5000,20000] [-r 10] [-i 200]
+"""
+
+import os
+import resource
+import socket
+import sys
+import time
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "library"))
+
+import reactor
+
+FD_SETSIZE = 1024
+
+
+def raiseLimit(needed):
+	"""
+	Tries to raise RLIMIT_NOFILE, returns the resulting soft limit
+	"""
+	soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+	if soft < needed:
+		target = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+		try:
+			resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+			soft = target
+		except (ValueError, resource.error):
+			pass
+	return soft
+
+
+def makeSockets(count):
+	socks = []
+	for x in xrange(count):
+		sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		sock.bind(("127.0.0.1", 0))
+		socks.append(sock)
+	return socks
+
+
+def measure(backend, socks, ready, iterations):
+	"""
+	Returns the average time of a wakeup in microseconds
+	"""
+	engine = backend()
+	for sock in socks:
+		engine.register(sock.fileno(), reactor.READ)
+	sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	# the ready sockets are spread across the whole set
+	step = max(len(socks) / ready, 1)
+	targets = [socks[i] for i in xrange(0, len(socks), step)][:ready]
+	for sock in targets:
+		sender.sendto("x", sock.getsockname())
+	# make sure the datagrams were delivered
+	engine.poll(1)
+	start = time.time()
+	for x in xrange(iterations):
+		events = engine.poll(1)
+	elapsed = time.time() - start
+	assert len(events) == len(targets), "got %d events instead of %d" % (len(events), len(targets))
+	for sock in targets:
+		sock.recv(1)
+	sender.close()
+	for sock in socks:
+		engine.unregister(sock.fileno())
+	return elapsed / iterations * 10 ** 6
+
+
+def main():
+	parser = ArgumentParser(description="reactor wakeup benchmark")
+	parser.add_argument("-n", "--sockets", default="500,5000,20000",
+		help="comma-separated numbers of sockets")
+	parser.add_argument("-r", "--ready", type=int, default=10,
+		help="how many sockets are ready on each wakeup")
+	parser.add_argument("-i", "--iterations", type=int, default=200,
+		help="wakeups per measurement")
+	args = parser.parse_args()
+
+	counts = [int(x) for x in args.sockets.split(",")]
+	limit = raiseLimit(max(counts) + 64)
+	print "%-8s %8s %14s" % ("backend", "sockets", "us per wakeup")
+	for count in counts:
+		if count + 64 > limit:
+			print "%-8s %8d %14s" % ("-", count, "skipped (RLIMIT_NOFILE is %d)" % limit)
+			continue
+		socks = makeSockets(count)
+		try:
+			for name in ("select", "poll", "epoll"):
+				backend = reactor.BACKENDS.get(name)
+				if not backend:
+					continue
+				if name == "select" and max(sock.fileno() for sock in socks) >= FD_SETSIZE:
+					print "%-8s %8d %14s" % (name, count, "n/a (FD_SETSIZE)")
+					continue
+				print "%-8s %8d %14.1f" % (name, count, measure(backend, socks, args.ready, args.iterations))
+		finally:
+			for sock in socks:
+				sock.close()
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,433 @@
+#!/usr/bin/env python2
+# coding: utf-8
+# This file is a part of VK4XMPP transport
+# © simpleApps, 2015.
+
+"""
+A local stand-in for the VK API and longpoll servers
+Used to load test the transport without network access
+Point the transport at it by setting VK_API_URL = "http://127.0.0.1:8080/method/" in the config
+Any token is accepted, each token is a separate synthetic user
+Usage: tools/fakevk.py [-p 8080] [-r 0.2] [-l 20,80] [-e 6=0.01,9=0.01,14=0.001,failed=0.01]
+"""
+
+import json
+import random
+import threading
+import time
+import urlparse
+import zlib
+from argparse import ArgumentParser
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+CHAT_ID_OFFSET = 2000000000
+# how long the longpoll server collects the events after the first one
+BATCH_WINDOW = 0.05
+# how many messages of each user are kept for messages.get and messages.getById
+HISTORY_SIZE = 500
+
+WORDS = ("hello", "how", "are", "you", "the", "transport", "works", "fine",
+	"привет", "как", "дела", "ok", "lol", "see", "you", "tomorrow")
+
+
+class ApiError(Exception):
+	"""
+	Raised by a method to reply with the error code
+	"""
+	pass
+
+
+class Options(object):
+	"""
+	The server settings (see the command line arguments)
+	"""
+	rate = 0.2
+	latency = (0, 0)
+	errors = {}
+	friends = 50
+	chats = 0.1
+	attachments = 0.1
+	mix = {"message": 0.7, "typing": 0.2, "status": 0.1}
+
+
+class FakeUser(object):
+	"""
+	The state of a synthetic user
+	"""
+	def __init__(self, uid, token):
+		self.uid = uid
+		self.token = token
+		self.key = "%x" % random.getrandbits(64)
+		self.ts = 1
+		self.pts = 1
+		self.mid = 0
+		self.messages = {}
+		self.friends = range(uid * 1000 + 1, uid * 1000 + 1 + Options.friends)
+		self.lock = threading.Lock()
+		self.nextEvent = time.time() + self.getInterval()
+
+	def getInterval(self):
+		return random.expovariate(Options.rate) if Options.rate else 3600
+
+	def makeMessage(self, peer=None, out=0, body=None):
+		"""
+		Stores a new message and returns it
+		Must be called under the lock
+		"""
+		self.mid += 1
+		self.pts += 1
+		friend = random.choice(self.friends)
+		chat = peer is None and random.random() < Options.chats
+		if peer is None:
+			peer = (CHAT_ID_OFFSET + 1 + friend % 10) if chat else friend
+		message = {"id": self.mid, "date": int(time.time()), "out": out,
+			"user_id": friend if peer > CHAT_ID_OFFSET else peer,
+			"read_state": 0, "title": " ... ",
+			"body": body if body is not None else " ".join(random.sample(WORDS, random.randint(1, 8))),
+			"peer": peer}
+		if peer > CHAT_ID_OFFSET:
+			message["chat_id"] = peer - CHAT_ID_OFFSET
+			message["title"] = "Chat #%d" % message["chat_id"]
+			message["chat_active"] = self.friends[:5]
+		if random.random() < Options.attachments:
+			photo = {"id": self.mid, "owner_id": friend, "date": message["date"],
+				"photo_130": "http://127.0.0.1/photo_130.jpg",
+				"photo_604": "http://127.0.0.1/photo_604.jpg"}
+			message["attachments"] = [{"type": "photo", "photo": photo}]
+		self.messages[self.mid] = message
+		if len(self.messages) > HISTORY_SIZE:
+			del self.messages[min(self.messages)]
+		return message
+
+	def makeEvent(self):
+		"""
+		Returns a longpoll event (the event mix is set by Options.mix)
+		Must be called under the lock
+		"""
+		choice = random.random()
+		for kind, share in sorted(Options.mix.items()):
+			choice -= share
+			if choice < 0:
+				break
+		friend = random.choice(self.friends)
+		if kind == "typing":
+			return [61, friend, 1]
+		if kind == "status":
+			return [random.choice((8, 9)), -friend, 7]
+		message = self.makeMessage()
+		extra = {}
+		if message["peer"] > CHAT_ID_OFFSET:
+			extra["from"] = str(message["user_id"])
+		if "attachments" in message:
+			extra.update({"attach1_type": "photo", "attach1": "%d_%d" % (friend, message["id"])})
+		return [4, message["id"], 1, message["peer"], message["date"],
+			message["title"], message["body"], extra]
+
+	def getEvents(self, wait):
+		"""
+		Waits for the events up to wait seconds
+		"""
+		deadline = time.time() + wait
+		with self.lock:
+			nextEvent = self.nextEvent
+		if nextEvent > deadline:
+			time.sleep(max(deadline - time.time(), 0))
+			return []
+		time.sleep(max(nextEvent - time.time(), 0) + BATCH_WINDOW)
+		updates = []
+		with self.lock:
+			while self.nextEvent <= time.time():
+				updates.append(self.makeEvent())
+				self.nextEvent += self.getInterval()
+			self.ts += 1
+		return updates
+
+	def toItem(self, message):
+		item = dict(message)
+		del item["peer"]
+		return item
+
+
+class FakeVK(object):
+	"""
+	Keeps the synthetic users and implements the API methods
+	"""
+	def __init__(self, address):
+		self.address = address
+		self.users = {}
+		self.keys = {}
+		self.lock = threading.Lock()
+		self.calls = {}
+
+	def getUser(self, token):
+		with self.lock:
+			if token not in self.users:
+				user = FakeUser(len(self.users) + 1, token)
+				self.users[token] = user
+				self.keys[user.key] = user
+			return self.users[token]
+
+	def getProfile(self, uid, fields):
+		profile = {"id": uid, "first_name": "User", "last_name": str(uid)}
+		for field in fields:
+			if field.startswith("photo"):
+				profile[field] = "http://127.0.0.1/%s.jpg" % field
+			elif field == "online":
+				profile["online"] = uid % 3 == 0
+			elif field == "screen_name":
+				profile["screen_name"] = "id%d" % uid
+		return profile
+
+	def call(self, method, args):
+		"""
+		Returns the API response body
+		"""
+		with self.lock:
+			self.calls[method] = self.calls.get(method, 0) + 1
+		low, high = Options.latency
+		if high:
+			time.sleep(random.uniform(low, high) / 1000.0)
+		for code in (6, 9, 14):
+			if random.random() < Options.errors.get(str(code), 0):
+				return self.error(code, method, args)
+
+		user = self.getUser(args.get("access_token", ""))
+		handler = getattr(self, "method_" + method.replace(".", "_"), None)
+		if not handler:
+			return self.error(3, method, args)
+		with user.lock:
+			try:
+				if method == "execute":
+					return handler(user, args)
+				return {"response": handler(user, args)}
+			except ApiError as e:
+				return self.error(e.args[0], method, args)
+
+	def error(self, code, method, args):
+		messages = {3: "Unknown method passed", 6: "Too many requests per second",
+			9: "Flood control", 14: "Captcha needed",
+			907: "Value of ts or pts is too old", 908: "Value of ts or pts is too new"}
+		error = {"error_code": code, "error_msg": messages[code],
+			"request_params": [{"key": key, "value": value} for key, value in args.items()]}
+		if code == 14:
+			error["captcha_sid"] = str(random.getrandbits(32))
+			error["captcha_img"] = "http://%s:%d/captcha.jpg" % self.address
+		return {"error": error}
+
+	def method_messages_getLongPollServer(self, user, args):
+		return {"key": user.key, "server": "http://%s:%d/im" % self.address,
+			"ts": user.ts, "pts": user.pts}
+
+	def method_messages_getLongPollHistory(self, user, args):
+		pts = int(args.get("pts", user.pts))
+		# the history is kept only for the last HISTORY_SIZE events
+		if pts > user.pts:
+			raise ApiError(908)
+		if user.pts - pts > HISTORY_SIZE:
+			raise ApiError(907)
+		items = [user.toItem(message) for mid, message in sorted(user.messages.items())
+			if message["id"] > user.mid - (user.pts - pts)]
+		return {"history": [], "messages": {"count": len(items), "items": items},
+			"new_pts": user.pts, "more": 0}
+
+	def method_messages_get(self, user, args):
+		lastID = int(args.get("last_message_id", 0))
+		count = int(args.get("count", 20))
+		items = [user.toItem(message) for mid, message in sorted(user.messages.items(), reverse=True)
+			if mid > lastID and not message["out"]][:count]
+		return {"count": len(items), "items": items}
+
+	def method_messages_getById(self, user, args):
+		ids = [int(mid) for mid in args.get("message_ids", "").split(",") if mid]
+		items = [user.toItem(user.messages[mid]) for mid in ids if mid in user.messages]
+		return {"count": len(items), "items": items}
+
+	def method_messages_send(self, user, args):
+		peer = int(args.get("user_id") or CHAT_ID_OFFSET + int(args.get("chat_id", 1)))
+		return user.makeMessage(peer, 1, args.get("message", ""))["id"]
+
+	def method_messages_getChat(self, user, args):
+		chat = int(args.get("chat_id", 1))
+		return {"id": chat, "type": "chat", "title": "Chat #%d" % chat,
+			"admin_id": user.friends[0], "users": user.friends[:5]}
+
+	def method_friends_get(self, user, args):
+		fields = [field for field in args.get("fields", "").split(",") if field]
+		if fields:
+			items = [self.getProfile(uid, fields) for uid in user.friends]
+		else:
+			items = list(user.friends)
+		return {"count": len(items), "items": items}
+
+	def method_friends_getLists(self, user, args):
+		return {"count": 0, "items": []}
+
+	def method_users_get(self, user, args):
+		ids = args.get("user_ids") or args.get("uids") or str(user.uid)
+		fields = [field for field in args.get("fields", "").split(",") if field]
+		return [self.getProfile(int(uid), fields) for uid in ids.split(",") if uid.isdigit()]
+
+	def method_groups_getById(self, user, args):
+		ids = args.get("group_ids") or args.get("group_id") or "1"
+		return [{"id": int(gid), "name": "Group %s" % gid, "screen_name": "club%s" % gid}
+			for gid in ids.split(",") if gid.isdigit()]
+
+	def method_isAppUser(self, user, args):
+		return 1
+
+	def method_account_getAppPermissions(self, user, args):
+		return 69638
+
+	def method_execute_getLastTime(self, user, args):
+		return int(time.time()) - 60
+
+	def method_execute(self, user, args):
+		"""
+		Supports only the code made by vkapi.Batcher: return [API.method({...}), ...];
+		Returns the whole response body as it has execute_errors in it
+		"""
+		code = args.get("code", "")
+		decoder = json.JSONDecoder()
+		results, errors = [], []
+		position = code.find("API.")
+		while position != -1:
+			start = code.index("(", position)
+			method = code[position + 4:start]
+			values, end = decoder.raw_decode(code, start + 1)
+			values = dict((key, unicode(value).encode("utf-8")) for key, value in values.items())
+			handler = getattr(self, "method_" + method.replace(".", "_"), None)
+			if handler:
+				results.append(handler(user, values))
+			else:
+				results.append(False)
+				errors.append({"method": method, "error_code": 3, "error_msg": "Unknown method passed"})
+			position = code.find("API.", end)
+		body = {"response": results}
+		if errors:
+			body["execute_errors"] = errors
+		return body
+
+	def simple(self, user, args):
+		return 1
+
+	method_account_setOnline = method_account_setOffline = simple
+	method_messages_markAsRead = method_messages_setActivity = simple
+	method_status_set = method_stats_trackVisitor = simple
+
+	def check(self, args):
+		"""
+		Handles the longpoll request
+		"""
+		user = self.keys.get(args.get("key"))
+		if not user:
+			return {"failed": 2}
+		if random.random() < Options.errors.get("failed", 0):
+			failed = random.choice((1, 2, 3))
+			return {"failed": failed, "ts": user.ts} if failed == 1 else {"failed": failed}
+		wait = min(int(args.get("wait", 25)), 90)
+		updates = user.getEvents(wait)
+		return {"ts": user.ts, "pts": user.pts, "updates": updates}
+
+
+class Handler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+
+	def log_message(self, *args):
+		pass
+
+	def getArgs(self):
+		url = urlparse.urlparse(self.path)
+		args = dict(urlparse.parse_qsl(url.query))
+		length = int(self.headers.get("Content-Length") or 0)
+		if length:
+			args.update(urlparse.parse_qsl(self.rfile.read(length)))
+		return url.path, args
+
+	def reply(self, body):
+		body = json.dumps(body)
+		self.send_response(200)
+		self.send_header("Content-Type", "application/json; charset=utf-8")
+		if "gzip" in self.headers.get("Accept-Encoding", ""):
+			compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+			body = compressor.compress(body) + compressor.flush()
+			self.send_header("Content-Encoding", "gzip")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def handle_request(self):
+		path, args = self.getArgs()
+		if path == "/im":
+			return self.reply(self.server.vk.check(args))
+		if path.startswith("/method/"):
+			return self.reply(self.server.vk.call(path[len("/method/"):], args))
+		self.send_error(404)
+
+	do_GET = do_POST = handle_request
+
+
+class Server(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+	request_queue_size = 1024
+
+
+def parsePairs(value):
+	return dict((key, float(share)) for key, share in (pair.split("=") for pair in value.split(",") if pair))
+
+
+def start(host="127.0.0.1", port=8080):
+	"""
+	Starts the server in a thread and returns it
+	"""
+	server = Server((host, port), Handler)
+	server.vk = FakeVK(server.server_address)
+	thread = threading.Thread(target=server.serve_forever, name="fakevk")
+	thread.daemon = True
+	thread.start()
+	return server
+
+
+def main():
+	parser = ArgumentParser(description="fake VK API and longpoll server")
+	parser.add_argument("-H", "--host", default="127.0.0.1")
+	parser.add_argument("-p", "--port", type=int, default=8080)
+	parser.add_argument("-r", "--rate", type=float, default=Options.rate,
+		help="longpoll events per second for each user")
+	parser.add_argument("-l", "--latency", default="0,0",
+		help="API latency range in milliseconds (min,max)")
+	parser.add_argument("-e", "--errors", default="",
+		help="error probabilities, e.g. 6=0.01,9=0.01,14=0.001,failed=0.01")
+	parser.add_argument("-m", "--mix", default="message=0.7,typing=0.2,status=0.1",
+		help="longpoll event mix")
+	parser.add_argument("-a", "--attachments", type=float, default=Options.attachments,
+		help="share of messages with attachments")
+	parser.add_argument("-c", "--chats", type=float, default=Options.chats,
+		help="share of messages from chats")
+	parser.add_argument("-f", "--friends", type=int, default=Options.friends,
+		help="friends of each user")
+	args = parser.parse_args()
+
+	Options.rate = args.rate
+	Options.latency = tuple(float(x) for x in args.latency.split(","))
+	Options.errors = parsePairs(args.errors)
+	Options.mix = parsePairs(args.mix)
+	Options.attachments = args.attachments
+	Options.chats = args.chats
+	Options.friends = args.friends
+
+	server = start(args.host, args.port)
+	print "fakevk: listening on http://%s:%d (VK_API_URL = \"http://%s:%d/method/\")" % (
+		server.server_address * 2)
+	try:
+		while True:
+			time.sleep(60)
+			calls = server.vk.calls.items()
+			print "fakevk: %d users, calls: %s" % (len(server.vk.users),
+				", ".join("%s=%d" % call for call in sorted(calls)))
+	except KeyboardInterrupt:
+		pass
+
+
+if __name__ == "__main__":
+	main()
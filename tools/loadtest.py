@@ -0,0 +1,206 @@
+#!/usr/bin/env python2
+# coding: utf-8
+# This file is a part of VK4XMPP transport
+# © simpleApps, 2015.
+
+"""
+Drives a number of synthetic users against tools/fakevk.py
+The "poll" mode runs the transport's Poll (and the worker processes if --shards is set),
+	the "api" mode calls the API methods by a number of threads
+The fake server is started as a separate process unless --url is given
+Usage: tools/loadtest.py [-m poll] [-n 1000] [-t 60] [-s 0] [-r 0.2] [-e 6=0.01,failed=0.01]
+"""
+
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+
+tools = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(tools, "..", "library"))
+
+parser = ArgumentParser(description="transport load test")
+parser.add_argument("-m", "--mode", choices=("poll", "api"), default="poll")
+parser.add_argument("-n", "--users", type=int, default=1000)
+parser.add_argument("-t", "--time", type=int, default=60, help="test duration in seconds")
+parser.add_argument("-s", "--shards", type=int, default=0, help="longpoll worker processes")
+parser.add_argument("-w", "--workers", type=int, default=8, help="longpoll worker threads")
+parser.add_argument("-T", "--threads", type=int, default=16, help="threads calling the API (api mode)")
+parser.add_argument("-u", "--url", help="VK_API_URL of a running fake server")
+parser.add_argument("-p", "--port", type=int, default=8089, help="port for the fake server")
+parser.add_argument("-r", "--rate", default="0.2", help="longpoll events per second for each user")
+parser.add_argument("-l", "--latency", default="0,0", help="API latency range in milliseconds")
+parser.add_argument("-e", "--errors", default="", help="error probabilities (see fakevk.py)")
+args = parser.parse_args()
+
+# the names the transport's modules import from __main__
+Transport = {}
+ALIVE = True
+DEBUG_POLL = False
+LONGPOLL_WORKERS = args.workers
+LONGPOLL_INIT_CONCURRENCY = 4
+LONGPOLL_SHARDS = args.shards
+crashDir = "crash"
+
+logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(levelname)s: %(message)s")
+logger = logging.getLogger("vk4xmpp")
+
+from writer import crashLog
+import metrics
+import vkapi as api
+from longpoll import Poll, Shards
+
+json = api.json
+requests = metrics.meter("loadtest/api/calls")
+latency = metrics.histogram("loadtest/api/latency")
+failures = metrics.counter("loadtest/api/errors")
+messages = metrics.counter("loadtest/poll/messages", "messages")
+
+
+class SyntheticVK(object):
+	"""
+	Does the same longpoll calls the transport's VK class does
+	"""
+	def __init__(self, source, token):
+		self.source = source
+		self.online = True
+		self.pollInitialzed = False
+		self.pollServer = None
+		self.pollConnection = None
+		self.pollConfig = {"mode": 98, "wait": 25, "act": "a_check"}
+		self.engine = api.APIBinding(token, logline=source)
+
+	def initPoll(self):
+		self.pollInitialzed = False
+		try:
+			response = self.engine.method("messages.getLongPollServer", {"use_ssl": 1, "need_pts": 1})
+		except Exception:
+			response = None
+		if not response:
+			return False
+		self.setPollServer(response)
+		return True
+
+	def setPollServer(self, response):
+		response = dict(response)
+		self.pollServer = response.pop("server")
+		if "://" not in self.pollServer:
+			self.pollServer = "https://%s" % self.pollServer
+		response.pop("pts", None)
+		self.pollConfig.update(response)
+		self.pollInitialzed = True
+
+	def makePoll(self):
+		if not self.pollInitialzed:
+			raise api.LongPollError("The Poll wasn't initialized yet")
+		self.pollConnection = api.AsyncHTTPRequest.getOpener(self.pollServer, self.pollConfig,
+			self.pollConnection)
+		return self.pollConnection
+
+
+class SyntheticUser(object):
+	"""
+	Processes the longpoll results the same way the transport's User does,
+		but doesn't send anything
+	"""
+	def __init__(self, number):
+		self.source = "user%d@loadtest" % number
+		self.vk = SyntheticVK(self.source, "token%d" % number)
+
+	def processPollResult(self, opener):
+		try:
+			data = opener.read()
+		except Exception:
+			Poll.reconnects["socket"].inc()
+			return 1 if opener.reused else 0
+		try:
+			data = json.loads(data)
+			if not data:
+				raise ValueError()
+		except ValueError:
+			Poll.reconnects["empty"].inc()
+			return 1
+		return self.processPollData(data)
+
+	def processPollData(self, data):
+		if "failed" in data:
+			Poll.reconnects["failed"].inc()
+			return 0
+		self.vk.pollConfig["ts"] = data["ts"]
+		updates = data.get("updates", ())
+		Poll.events.observe(len(updates))
+		messages.inc(len([evt for evt in updates if evt[0] == 4]))
+		return 1
+
+
+def startServer():
+	command = [sys.executable, os.path.join(tools, "fakevk.py"), "-p", str(args.port),
+		"-r", args.rate, "-l", args.latency, "-e", args.errors]
+	process = subprocess.Popen(command)
+	time.sleep(1)
+	return process
+
+
+def runPoll():
+	users = [SyntheticUser(number) for number in xrange(args.users)]
+	for user in users:
+		Transport[user.source] = user
+	threading.Thread(target=Poll.process, name="longPoll").start()
+	for user in users:
+		if args.shards or user.vk.initPoll():
+			Poll.add(user)
+		else:
+			logger.error("unable to initialize poll for %s", user.source)
+
+
+def callAPI(number):
+	engine = api.APIBinding("token%d" % number)
+	calls = (("users.get", {"user_ids": "1,2,3", "fields": "photo_100"}),
+		("messages.send", {"user_id": 1, "message": "test"}))
+	while True:
+		for method, values in calls:
+			start = time.time()
+			try:
+				engine.method(method, dict(values))
+			except Exception:
+				failures.inc()
+			requests.mark()
+			latency.observe((time.time() - start) * 1000)
+
+
+def runAPI():
+	for number in xrange(args.threads):
+		thread = threading.Thread(target=callAPI, args=(number,), name="api-%d" % number)
+		thread.daemon = True
+		thread.start()
+
+
+def report():
+	for name, value, units in metrics.read():
+		print "%-36s %12s %s" % (name, value, units)
+	print
+
+
+def main():
+	api.API_URL = args.url or "http://127.0.0.1:%d/method/" % args.port
+	# the worker processes must be started after the url is set
+	if args.shards:
+		Shards.start(args.shards)
+	server = None if args.url else startServer()
+	try:
+		runPoll() if args.mode == "poll" else runAPI()
+		end = time.time() + args.time
+		while time.time() < end:
+			time.sleep(min(10, max(end - time.time(), 0)))
+			report()
+	finally:
+		if server:
+			server.terminate()
+		os._exit(0)
+
+
+if __name__ == "__main__":
+	main()